@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''
+
+Sending SQS and SNS messages in batches
+
+- Sending a batch of entries with 'send_message_batch' or 'publish_batch' and retrying only the entries
+  which failed on the side of the service
+- Turning a failed call into a failure of each of its entries, so the caller gets a result for every message
+- Deduplication ids of the messages of fifo queues and topics, random or from the hash of the body
+
+'''
+
+# Import necessary packages
+import hashlib
+import time
+import random
+from uuid import uuid4
+from botocore.exceptions import ClientError, BotoCoreError
+
+
+# Function to get the deduplication id of a message from a hash of its body
+# Sending the same body again within the 5 minutes deduplication interval does not create a second message
+def content_dedup_id(body):
+    return hashlib.sha256(body.encode('utf-8')).hexdigest()
+
+
+# Function to get the deduplication id of a message, a random one unless content deduplication is asked for,
+# so identical bodies sent on purpose are all delivered
+def dedup_id(body, content_dedup=False):
+    if content_dedup:
+        return content_dedup_id(body)
+    return str(uuid4())
+
+
+# Function to build the failure of an entry from the error of a whole call, in the format of the 'Failed' entries
+def call_failure(entry_id, error):
+    if isinstance(error, ClientError):
+        code = error.response['Error']['Code']
+        sender_fault = error.response['Error'].get('Type') == 'Sender'
+    else:
+        code = type(error).__name__
+        sender_fault = False
+    return {'Id': entry_id, 'Code': code, 'SenderFault': sender_fault, 'Message': str(error)}
+
+
+# Function to build the failure of an entry which was not sent, for example after an earlier message of its fifo group failed
+def unsent(entry_id):
+    return {'Id': entry_id, 'Code': 'NotSent', 'SenderFault': False, 'Message': 'An earlier message failed'}
+
+
+# Function to send a batch of entries with a batch call of sqs or sns, for example
+#
+#   send_batch(lambda entries: sqs.send_message_batch(QueueUrl=queue_url, Entries=entries), entries)
+#
+# The call gets the entries still to send and returns the response with the 'Successful' and 'Failed' entries.
+# Only the failed entries are sent again, returns the result of every entry by its 'Id'. A call which raises,
+# once botocore gave up retrying it, fails all the entries still pending with its error instead of raising
+def send_batch(call, entries, max_retries=5, backoff=0.1):
+    results = {}
+    # The 'Id' of an entry only has to be unique inside the batch, here it is the position of the message
+    pending = entries
+    attempt = 0
+    while pending:
+        try:
+            response = call(pending)
+        except (ClientError, BotoCoreError) as e:
+            for entry in pending:
+                results[entry['Id']] = call_failure(entry['Id'], e)
+            break
+        for success in response.get('Successful', []):
+            results[success['Id']] = success
+        retry = []
+        by_id = {entry['Id']: entry for entry in pending}
+        for failure in response.get('Failed', []):
+            # Errors caused by the message itself fail the same way on every retry
+            if failure.get('SenderFault') or attempt >= max_retries:
+                results[failure['Id']] = failure
+            else:
+                retry.append(by_id[failure['Id']])
+        if retry:
+            # Wait with an exponential backoff and some jitter before sending the failed entries again
+            time.sleep(backoff * (2 ** attempt) * random.uniform(0.5, 1.5))
+        attempt += 1
+        pending = retry
+    return results
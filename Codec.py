@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''
+
+Codecs to encode the payloads sent over Kinesis streams, SQS queues and SNS topics
+
+- Encoding a payload as JSON, msgpack or a fixed struct layout
+- Compressing the encoded payload with zlib or zstd
+- A marker and a header byte in front of the payload so the receiver detects the codec by itself
+- Text encoding of the binary payloads for SQS and SNS message bodies
+- Benchmarking the encoding and decoding throughput of the codecs when run as a script
+
+'''
+
+# Import necessary packages
+import json
+import struct
+import zlib
+import base64
+import time
+
+# The optional codecs are only available when their packages are installed
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# An encoded payload starts with a marker byte and a header byte. 0xc1 is never used by UTF-8 nor by msgpack,
+# so a plain text, JSON or msgpack payload written without a codec is never taken for an encoded one
+FRAME_MARKER = 0xc1
+
+# The header byte holds the codec id in the low 4 bits and the compression id in the high 4 bits
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_ZSTD = 2
+
+# Prefix of a message body holding an encoded payload as text, SQS and SNS bodies must be text
+TEXT_PREFIX = '~c~'
+
+# Registered codecs by their name and by their id
+codecs_by_name = {}
+codecs_by_id = {}
+
+
+# Codec writing the payload as compact JSON
+class JSONCodec:
+    id = 1
+    name = 'json'
+
+    def encode(self, obj):
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+    def decode(self, data):
+        return json.loads(bytes(data).decode('utf-8'))
+
+
+# Codec writing the payload as msgpack, needs the 'msgpack' package
+class MsgpackCodec:
+    id = 2
+    name = 'msgpack'
+
+    def encode(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def decode(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+# Codec writing a dictionary with fixed fields as a packed struct, for example
+#
+#   StructCodec(3, 'sensor', [('prop', 'i'), ('timestamp', 'q')])
+#
+# writes {'prop': 80, 'timestamp': 1577836800} in 12 bytes
+class StructCodec:
+
+    def __init__(self, id, name, fields):
+        self.id = id
+        self.name = name
+        self.fields = [field for field, _ in fields]
+        # Little endian without padding between the fields
+        self.struct = struct.Struct('<' + ''.join(fmt for _, fmt in fields))
+
+    def encode(self, obj):
+        return self.struct.pack(*[obj[field] for field in self.fields])
+
+    def decode(self, data):
+        return dict(zip(self.fields, self.struct.unpack(data)))
+
+
+# Function to register a codec, the id has to fit into the 4 bits of the header
+def register_codec(codec):
+    if not 0 < codec.id < 16:
+        raise ValueError('Codec id must be between 1 and 15')
+    if codecs_by_id.get(codec.id, codec).name != codec.name:
+        raise ValueError('Codec id {} is already used by {}'.format(codec.id, codecs_by_id[codec.id].name))
+    codecs_by_name[codec.name] = codec
+    codecs_by_id[codec.id] = codec
+    return codec
+
+
+register_codec(JSONCodec())
+if msgpack is not None:
+    register_codec(MsgpackCodec())
+
+# Codec for the sensor readings sent by the kinesis producer
+SENSOR_CODEC = register_codec(StructCodec(3, 'sensor', [('prop', 'i'), ('timestamp', 'q')]))
+
+
+# Compress the encoded payload
+def _compress(data, compression):
+    if compression == COMPRESSION_ZLIB:
+        return zlib.compress(data)
+    if compression == COMPRESSION_ZSTD:
+        if zstandard is None:
+            raise ValueError('zstd compression needs the zstandard package')
+        return zstandard.ZstdCompressor().compress(data)
+    return data
+
+
+# Decompress the payload
+def _decompress(data, compression):
+    if compression == COMPRESSION_ZLIB:
+        return zlib.decompress(data)
+    if compression == COMPRESSION_ZSTD:
+        if zstandard is None:
+            raise ValueError('zstd compression needs the zstandard package')
+        return zstandard.ZstdDecompressor().decompress(data)
+    return data
+
+
+# Function to encode a payload with a codec and optionally compress it, returns the bytes with the marker and header
+def encode(obj, codec='json', compression=COMPRESSION_NONE):
+    codec = codecs_by_name[codec] if isinstance(codec, str) else codec
+    data = _compress(codec.encode(obj), compression)
+    return bytes([FRAME_MARKER, codec.id | compression << 4]) + data
+
+
+# Function to decode a payload, the codec and the compression are read from the header byte
+def decode(data):
+    # Payloads without the marker, for example plain JSON written before the codecs, are returned as they are
+    if len(data) < 2 or data[0] != FRAME_MARKER:
+        return data
+    header = data[1]
+    codec = codecs_by_id.get(header & 0x0f)
+    compression = header >> 4
+    if codec is None or compression > COMPRESSION_ZSTD:
+        raise ValueError('Unknown codec header {:#04x}'.format(header))
+    return codec.decode(_decompress(data[2:], compression))
+
+
+# Function to encode a payload as text for the message bodies of SQS and SNS
+def encode_text(obj, codec='json', compression=COMPRESSION_NONE):
+    return TEXT_PREFIX + base64.b64encode(encode(obj, codec, compression)).decode('ascii')
+
+
+# Function to decode a message body, bodies which were not encoded are returned as they are
+def decode_text(body):
+    if not body.startswith(TEXT_PREFIX):
+        return body
+    return decode(base64.b64decode(body[len(TEXT_PREFIX):]))
+
+
+# Function to check that the payloads come back from every codec and that the payloads
+# written without a codec are returned as they are, even when they start with a byte like a header
+def self_test():
+    payload = {'prop': 87, 'timestamp': 1577836800}
+    compressions = [COMPRESSION_NONE, COMPRESSION_ZLIB] + ([COMPRESSION_ZSTD] if zstandard is not None else [])
+    for name in codecs_by_name:
+        for compression in compressions:
+            assert decode(encode(payload, name, compression)) == payload, (name, compression)
+            assert decode_text(encode_text(payload, name, compression)) == payload, (name, compression)
+    # 0x22 was read as a msgpack header with zstd compression, '{' and '[' as other codecs
+    for raw in [b'"abc"', b'{"prop":87}', b'[1,2]', b'1', b'\x01\x02', b'', b'\xc1']:
+        assert decode(raw) == raw, raw
+    assert decode_text('"abc"') == '"abc"'
+    if msgpack is not None:
+        raw = msgpack.packb(payload)
+        assert decode(raw) == raw
+
+
+# Function to measure how many payloads per second a codec encodes and decodes
+def benchmark(payload, codec, compression=COMPRESSION_NONE, count=100000):
+    start = time.perf_counter()
+    for _ in range(count):
+        data = encode(payload, codec, compression)
+    encode_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(count):
+        decode(data)
+    decode_time = time.perf_counter() - start
+    return {
+        'codec': codec,
+        'compression': compression,
+        'bytes': len(data),
+        'encode_per_sec': count / encode_time,
+        'decode_per_sec': count / decode_time
+    }
+
+
+if __name__ == '__main__':
+    self_test()
+
+    # A sensor reading as sent by the kinesis producer
+    payload = {'prop': 87, 'timestamp': 1577836800}
+
+    # The same payload as the kinesis producer used to send it, stringified values in JSON
+    print('plain json bytes', len(json.dumps({'prop': str(87), 'timestamp': str(1577836800)})))
+
+    compressions = [COMPRESSION_NONE, COMPRESSION_ZLIB]
+    if zstandard is not None:
+        compressions.append(COMPRESSION_ZSTD)
+
+    # Benchmark every registered codec with every available compression
+    for name in codecs_by_name:
+        for compression in compressions:
+            result = benchmark(payload, name, compression)
+            print('{codec:>8} compression={compression} bytes={bytes:>3} '
+                  'encode/s={encode_per_sec:>10.0f} decode/s={decode_per_sec:>10.0f}'.format(**result))
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''
+
+A benchmark of the kinesis producer and consumer against a local stand-in for the kinesis service
+
+- An in-process kinesis with configurable call latency and per shard throttling
+- The synthetic readings of the producer example sent through the batching producer
+- Reading the records back with the multi shard consumer
+- Reporting the records per second, the latency histogram of the 'put_records' calls,
+  the end to end lag and the CPU time per record for different batch sizes, shard counts and codecs
+
+'''
+
+# Import necessary packages
+import os
+import argparse
+import bisect
+import hashlib
+import random
+import threading
+import time
+from botocore.exceptions import ClientError
+
+# The producer and consumer modules create a kinesis client when imported, which needs a region
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import Codec
+import Kinesis_Producer
+import Kinesis_Consumer
+
+
+# Create a token bucket allowing a number of units per second
+class TokenBucket:
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.time()
+
+    # Take the units if there are enough tokens left
+    def take(self, units):
+        now = time.time()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < units:
+            return False
+        self.tokens -= units
+        return True
+
+
+# Create an in-process stand-in for the kinesis calls used by the producer and the consumer
+#
+# Every call sleeps for the configured latency. With throttling enabled each shard accepts
+# 1000 records and 1 MB per second and 5 'get_records' calls per second, like the real service.
+class LocalKinesis:
+
+    def __init__(self, shard_count=1, latency=0.005, throttle=False):
+        self.latency = latency
+        self.throttle = throttle
+        self.lock = threading.Lock()
+        self.shards = []
+        for i in range(shard_count):
+            start = i * 2 ** 128 // shard_count
+            end = (i + 1) * 2 ** 128 // shard_count - 1
+            self.shards.append({
+                'ShardId': 'shardId-{:012d}'.format(i),
+                'HashKeyRange': {'StartingHashKey': str(start), 'EndingHashKey': str(end)},
+                'SequenceNumberRange': {'StartingSequenceNumber': '0'}
+            })
+        self.starting_keys = [int(shard['HashKeyRange']['StartingHashKey']) for shard in self.shards]
+        self.records = {shard['ShardId']: [] for shard in self.shards}
+        self.write_records = {shard['ShardId']: TokenBucket(1000) for shard in self.shards}
+        self.write_bytes = {shard['ShardId']: TokenBucket(1024 * 1024) for shard in self.shards}
+        self.reads = {shard['ShardId']: TokenBucket(5) for shard in self.shards}
+
+    def list_shards(self, StreamName=None, NextToken=None):
+        time.sleep(self.latency)
+        return {'Shards': [dict(shard) for shard in self.shards]}
+
+    # Find the shard of a record the same way kinesis does
+    def _shard_for(self, record):
+        if 'ExplicitHashKey' in record:
+            hash_key = int(record['ExplicitHashKey'])
+        else:
+            hash_key = int(hashlib.md5(record['PartitionKey'].encode('utf-8')).hexdigest(), 16)
+        return self.shards[bisect.bisect_right(self.starting_keys, hash_key) - 1]['ShardId']
+
+    def put_records(self, StreamName, Records):
+        time.sleep(self.latency)
+        results = []
+        failed = 0
+        with self.lock:
+            for record in Records:
+                shard_id = self._shard_for(record)
+                size = len(record['Data']) + len(record['PartitionKey'])
+                if self.throttle and not (self.write_records[shard_id].take(1) and
+                                          self.write_bytes[shard_id].take(size)):
+                    failed += 1
+                    results.append({'ErrorCode': 'ProvisionedThroughputExceededException',
+                                    'ErrorMessage': 'Rate exceeded for shard ' + shard_id})
+                    continue
+                records = self.records[shard_id]
+                sequence_number = '{:020d}'.format(len(records))
+                records.append({'Data': record['Data'],
+                                'PartitionKey': record['PartitionKey'],
+                                'SequenceNumber': sequence_number,
+                                'ApproximateArrivalTimestamp': time.time()})
+                results.append({'ShardId': shard_id, 'SequenceNumber': sequence_number})
+        return {'FailedRecordCount': failed, 'Records': results}
+
+    def get_shard_iterator(self, StreamName, ShardId, ShardIteratorType, StartingSequenceNumber=None):
+        time.sleep(self.latency)
+        with self.lock:
+            position = len(self.records[ShardId]) if ShardIteratorType == 'LATEST' else 0
+        if ShardIteratorType == 'AT_SEQUENCE_NUMBER':
+            position = int(StartingSequenceNumber)
+        elif ShardIteratorType == 'AFTER_SEQUENCE_NUMBER':
+            position = int(StartingSequenceNumber) + 1
+        return {'ShardIterator': '{}:{}'.format(ShardId, position)}
+
+    def get_records(self, ShardIterator, Limit=10000):
+        time.sleep(self.latency)
+        shard_id, position = ShardIterator.rsplit(':', 1)
+        position = int(position)
+        with self.lock:
+            if self.throttle and not self.reads[shard_id].take(1):
+                raise ClientError({'Error': {'Code': 'ProvisionedThroughputExceededException',
+                                             'Message': 'Rate exceeded for shard ' + shard_id}}, 'GetRecords')
+            records = self.records[shard_id][position:position + Limit]
+            total = len(self.records[shard_id])
+        position += len(records)
+        behind = 0
+        if position < total:
+            behind = int((time.time() - self.records[shard_id][position]['ApproximateArrivalTimestamp']) * 1000)
+        return {'Records': records,
+                'NextShardIterator': '{}:{}'.format(shard_id, position),
+                'MillisBehindLatest': behind}
+
+
+# Create a wrapper around a client which records the latency of the 'put_records' calls
+class TimedClient:
+
+    def __init__(self, client):
+        self.client = client
+        self.latencies = []
+
+    def put_records(self, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self.client.put_records(**kwargs)
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+# Function to get a percentile of a list of values
+def percentile(values, percent):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(percent / 100.0 * len(values)))]
+
+
+# Function to count the latencies in buckets doubling from one millisecond
+def histogram(latencies):
+    buckets = {}
+    for latency in latencies:
+        bound = 1
+        while latency * 1000 > bound:
+            bound *= 2
+        buckets[bound] = buckets.get(bound, 0) + 1
+    return sorted(buckets.items())
+
+
+# Function to run the producer and the consumer once and measure them
+def run(record_count, batch_size, shard_count, codec, latency, throttle, aggregate):
+    local = LocalKinesis(shard_count, latency, throttle)
+    client = TimedClient(local)
+    lags = []
+    done = threading.Event()
+    lock = threading.Lock()
+
+    # Processor measuring the time from creating the reading to processing it
+    def processor(shard_id, record):
+        payload = Codec.decode(record['Data'])
+        with lock:
+            lags.append(time.time() - payload['timestamp'] / 1e6)
+            if len(lags) >= record_count:
+                done.set()
+
+    consumer = Kinesis_Consumer.StreamConsumer('benchmark', processor, client=local,
+                                               iterator_type='TRIM_HORIZON', poll_interval=0.01,
+                                               max_poll_interval=0.05)
+    consumer.start()
+    router = Kinesis_Producer.ShardRouter('benchmark', client=local)
+    producer = Kinesis_Producer.BatchProducer('benchmark', client=client, max_records=batch_size,
+                                              aggregate=aggregate, router=router, backoff=0.01, max_retries=50)
+    cpu_start = time.process_time()
+    start = time.time()
+    for _ in range(record_count):
+        # The synthetic reading of the producer example, timestamped in microseconds to measure the lag
+        payload = {'prop': random.randint(40, 120), 'timestamp': int(time.time() * 1e6)}
+        producer.put(Codec.encode(payload, codec), 'thing-{}'.format(random.randint(0, 99)))
+    producer.close()
+    produce_time = time.time() - start
+    done.wait(60)
+    total_time = time.time() - start
+    cpu_time = time.process_time() - cpu_start
+    consumer.stop()
+    return {
+        'batch': batch_size,
+        'shards': shard_count,
+        'codec': codec,
+        'produced_per_sec': record_count / produce_time,
+        'consumed_per_sec': len(lags) / total_time,
+        'put_p50_ms': percentile(client.latencies, 50) * 1000,
+        'put_p99_ms': percentile(client.latencies, 99) * 1000,
+        'lag_p50_ms': percentile(lags, 50) * 1000,
+        'lag_p99_ms': percentile(lags, 99) * 1000,
+        'cpu_us_per_record': cpu_time / record_count * 1e6,
+        'failed': producer.failed_count,
+        'histogram': histogram(client.latencies)
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the kinesis producer and consumer')
+    parser.add_argument('--records', type=int, default=20000, help='Records sent in every run')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 100, 500])
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--codecs', nargs='+', default=sorted(Codec.codecs_by_name))
+    parser.add_argument('--latency', type=float, default=0.005, help='Latency of every call in seconds')
+    parser.add_argument('--throttle', action='store_true', help='Throttle the shards like the real service')
+    parser.add_argument('--aggregate', action='store_true', help='Aggregate the records in the KPL format')
+    args = parser.parse_args()
+
+    for shard_count in args.shards:
+        for batch_size in args.batch_sizes:
+            for codec in args.codecs:
+                result = run(args.records, batch_size, shard_count, codec, args.latency, args.throttle, args.aggregate)
+                print('shards={shards} batch={batch:>3} codec={codec:>7} '
+                      'produced/s={produced_per_sec:>8.0f} consumed/s={consumed_per_sec:>8.0f} '
+                      'put p50={put_p50_ms:.1f}ms p99={put_p99_ms:.1f}ms '
+                      'lag p50={lag_p50_ms:.0f}ms p99={lag_p99_ms:.0f}ms '
+                      'cpu/record={cpu_us_per_record:.1f}us failed={failed}'.format(**result))
+                print('    put latency histogram (<= ms: calls)',
+                      ', '.join('{}: {}'.format(bound, count) for bound, count in result['histogram']))
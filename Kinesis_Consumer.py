@@ -10,6 +10,14 @@ An example to demonstrate how to receive data from
 AWS Kinesis streams sent by a stream producer and processing
 of the data
 
+- De-aggregating the records packed by the producer in the KPL format
+- Reading all the shards of the stream in parallel with a worker thread per shard
+- Checkpointing the processed records and leasing the shards, so a restarted consumer resumes where it stopped
+- Polling each shard at a rate adapted to the incoming records and the lag of the consumer
+- Following the parent and child shards after a split or merge, reading each parent before its children
+- Decoding the payloads written with any of the codecs
+- Aggregating the readings of each thing over tumbling and sliding windows
+
 """
 
 
@@ -18,6 +26,15 @@ import boto3
 import json
 from datetime import datetime
 import time
+import random
+import hashlib
+import queue
+import threading
+from collections import Counter
+import sqlite3
+from uuid import uuid4
+from botocore.exceptions import ClientError, BotoCoreError
+import Codec
 
 # Create a boto3 session and get the region name
 session = boto3.session.Session()
@@ -28,34 +45,969 @@ kinesis_client = boto3.client('kinesis', region_name=region_name)
 
 stream_name = 'new_stream'
 
-# Get the details of streams defined in the aws account
-response = kinesis_client.describe_stream(StreamName=stream_name)
+# Magic bytes at the start of a record aggregated in the format of the Kinesis Producer Library (KPL)
+KPL_MAGIC = b'\xf3\x89\x9a\xc2'
+
+# Checkpoint written for a closed shard once all its records are processed
+SHARD_END = 'SHARD_END'
+
+
+# Decode a protobuf varint starting at the given position, returns the value and the next position
+def _read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+# Walk over the fields of a protobuf message, yielding the field number and its value
+def _read_fields(buf):
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        key, pos = _read_varint(buf, pos)
+        field_number, wire_type = key >> 3, key & 0x7
+        # Varint field
+        if wire_type == 0:
+            value, pos = _read_varint(buf, pos)
+        # Length delimited field
+        elif wire_type == 2:
+            length, pos = _read_varint(buf, pos)
+            value = buf[pos:pos + length]
+            pos += length
+        # Fixed 64 bit field
+        elif wire_type == 1:
+            value = buf[pos:pos + 8]
+            pos += 8
+        # Fixed 32 bit field
+        elif wire_type == 5:
+            value = buf[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError('Unsupported protobuf wire type {}'.format(wire_type))
+        yield field_number, value
+
+
+# Check whether a kinesis record holds user records aggregated in the KPL format
+def is_aggregated(data):
+    # The record needs the magic bytes, a message and the 16 bytes md5 digest
+    if len(data) <= len(KPL_MAGIC) + 16 or not data.startswith(KPL_MAGIC):
+        return False
+    message = data[len(KPL_MAGIC):-16]
+    return hashlib.md5(message).digest() == data[-16:]
+
+
+# Split an aggregated kinesis record into the user records packed in it
+def deaggregate(record):
+    data = record['Data']
+    # Records which are not aggregated are passed through as they are, without a sub sequence number
+    if not is_aggregated(data):
+        yield record
+        return
+    message = memoryview(data)[len(KPL_MAGIC):-16]
+    partition_keys = []
+    explicit_hash_keys = []
+    # The key tables are written before the records, so they are complete when the records are read
+    for field_number, value in _read_fields(message):
+        if field_number == 1:
+            partition_keys.append(bytes(value).decode('utf-8'))
+        elif field_number == 2:
+            explicit_hash_keys.append(bytes(value).decode('utf-8'))
+    sub_sequence = 0
+    for field_number, value in _read_fields(message):
+        if field_number != 3:
+            continue
+        user_record = {
+            'SequenceNumber': record.get('SequenceNumber'),
+            'SubSequenceNumber': sub_sequence,
+            'ApproximateArrivalTimestamp': record.get('ApproximateArrivalTimestamp')
+        }
+        for inner_number, inner_value in _read_fields(value):
+            if inner_number == 1:
+                user_record['PartitionKey'] = partition_keys[inner_value]
+            elif inner_number == 2:
+                user_record['ExplicitHashKey'] = explicit_hash_keys[inner_value]
+            elif inner_number == 3:
+                user_record['Data'] = bytes(inner_value)
+        sub_sequence += 1
+        yield user_record
+
+
+# Function to yield the user records of all the records in a 'get_records' response
+def deaggregate_records(records):
+    for record in records:
+        for user_record in deaggregate(record):
+            yield user_record
+
+
+# Function to list all the shards of a stream, following the pages of 'list_shards'
+def list_all_shards(stream_name, client=None):
+    client = client or kinesis_client
+    shards = []
+    response = client.list_shards(StreamName=stream_name)
+    shards.extend(response['Shards'])
+    # The stream name must not be passed in together with the token for the next page
+    while response.get('NextToken'):
+        response = client.list_shards(NextToken=response['NextToken'])
+        shards.extend(response['Shards'])
+    return shards
+
+
+# Create an in-memory store for the checkpoints and leases of the shards, useful for testing
+#
+# Every store has the same methods:
+# - get_checkpoint(shard_id) returns the (sequence number, sub sequence number) checkpointed for a shard or None
+# - set_checkpoint(shard_id, sequence_number, sub_sequence, owner) stores a checkpoint, returns False if the lease is lost
+# - acquire_lease(shard_id, owner, duration) takes or renews the lease on a shard, returns whether it is held
+# - release_lease(shard_id, owner) gives up a lease so another consumer can take the shard right away
+class MemoryCheckpointStore:
+
+    def __init__(self):
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def get_checkpoint(self, shard_id):
+        with self.lock:
+            item = self.items.get(shard_id)
+        if not item or item.get('checkpoint') is None:
+            return None
+        return item['checkpoint'], item.get('sub_sequence')
+
+    def set_checkpoint(self, shard_id, sequence_number, sub_sequence=None, owner=None):
+        with self.lock:
+            item = self.items.setdefault(shard_id, {})
+            # Only the consumer holding the lease may move the checkpoint
+            if owner is not None and item.get('owner') not in (None, owner):
+                return False
+            item['checkpoint'] = sequence_number
+            item['sub_sequence'] = sub_sequence
+            return True
+
+    def acquire_lease(self, shard_id, owner, duration):
+        now = time.time()
+        with self.lock:
+            item = self.items.setdefault(shard_id, {})
+            # The lease can be taken when nobody holds it, it already belongs to the owner or it has expired
+            if item.get('owner') in (None, owner) or item.get('expiry', 0) < now:
+                item['owner'] = owner
+                item['expiry'] = now + duration
+                return True
+            return False
+
+    def release_lease(self, shard_id, owner):
+        with self.lock:
+            item = self.items.get(shard_id)
+            if item and item.get('owner') == owner:
+                item['owner'] = None
+                item['expiry'] = 0
+
+
+# Create a store keeping the checkpoints and leases in a SQLite database file
+class SQLiteCheckpointStore:
+
+    def __init__(self, path=':memory:'):
+        # The connection is shared by the worker threads, so the access is guarded by a lock
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS checkpoints ('
+                                    'shard_id TEXT PRIMARY KEY, '
+                                    'checkpoint TEXT, '
+                                    'sub_sequence INTEGER, '
+                                    'lease_owner TEXT, '
+                                    'lease_expiry REAL DEFAULT 0)')
+
+    def get_checkpoint(self, shard_id):
+        with self.lock:
+            row = self.connection.execute('SELECT checkpoint, sub_sequence FROM checkpoints WHERE shard_id = ?',
+                                          (shard_id,)).fetchone()
+        if not row or row[0] is None:
+            return None
+        return row[0], row[1]
+
+    def set_checkpoint(self, shard_id, sequence_number, sub_sequence=None, owner=None):
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR IGNORE INTO checkpoints (shard_id) VALUES (?)', (shard_id,))
+            # Only the consumer holding the lease may move the checkpoint
+            cursor = self.connection.execute('UPDATE checkpoints SET checkpoint = ?, sub_sequence = ? '
+                                             'WHERE shard_id = ? AND (? IS NULL OR lease_owner IS NULL OR lease_owner = ?)',
+                                             (sequence_number, sub_sequence, shard_id, owner, owner))
+            return cursor.rowcount == 1
+
+    def acquire_lease(self, shard_id, owner, duration):
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR IGNORE INTO checkpoints (shard_id) VALUES (?)', (shard_id,))
+            cursor = self.connection.execute('UPDATE checkpoints SET lease_owner = ?, lease_expiry = ? '
+                                             'WHERE shard_id = ? AND (lease_owner IS NULL OR lease_owner = ? OR lease_expiry < ?)',
+                                             (owner, now + duration, shard_id, owner, now))
+            return cursor.rowcount == 1
+
+    def release_lease(self, shard_id, owner):
+        with self.lock, self.connection:
+            self.connection.execute('UPDATE checkpoints SET lease_owner = NULL, lease_expiry = 0 '
+                                    'WHERE shard_id = ? AND lease_owner = ?', (shard_id, owner))
+
+
+# Create a store keeping the checkpoints and leases in a DynamoDB table, one item per shard
+class DynamoDBCheckpointStore:
+
+    def __init__(self, table_name, client=None):
+        self.table_name = table_name
+        # Create a dynamodb client in the current region if no client is passed in
+        self.client = client or boto3.client('dynamodb', region_name=region_name)
+
+    # Create the table with the shard id as the partition key, billed per request, unless it exists already
+    def create_table(self):
+        try:
+            self.client.create_table(TableName=self.table_name,
+                                     AttributeDefinitions=[{'AttributeName': 'shard_id', 'AttributeType': 'S'}],
+                                     KeySchema=[{'AttributeName': 'shard_id', 'KeyType': 'HASH'}],
+                                     BillingMode='PAY_PER_REQUEST')
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ResourceInUseException':
+                raise
+        # Wait until the table can be used
+        self.client.get_waiter('table_exists').wait(TableName=self.table_name)
+
+    def get_checkpoint(self, shard_id):
+        item = self.client.get_item(TableName=self.table_name,
+                                    Key={'shard_id': {'S': shard_id}},
+                                    ConsistentRead=True).get('Item')
+        if not item or 'checkpoint' not in item:
+            return None
+        sub_sequence = int(item['sub_sequence']['N']) if 'sub_sequence' in item else None
+        return item['checkpoint']['S'], sub_sequence
+
+    def set_checkpoint(self, shard_id, sequence_number, sub_sequence=None, owner=None):
+        values = {':checkpoint': {'S': sequence_number}}
+        if sub_sequence is None:
+            update = 'SET checkpoint = :checkpoint REMOVE sub_sequence'
+        else:
+            update = 'SET checkpoint = :checkpoint, sub_sequence = :sub_sequence'
+            values[':sub_sequence'] = {'N': str(sub_sequence)}
+        kwargs = {}
+        # Only the consumer holding the lease may move the checkpoint
+        if owner is not None:
+            kwargs['ConditionExpression'] = 'attribute_not_exists(lease_owner) OR lease_owner = :owner'
+            values[':owner'] = {'S': owner}
+        try:
+            self.client.update_item(TableName=self.table_name,
+                                    Key={'shard_id': {'S': shard_id}},
+                                    UpdateExpression=update,
+                                    ExpressionAttributeValues=values,
+                                    **kwargs)
+        except self.client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    def acquire_lease(self, shard_id, owner, duration):
+        now = time.time()
+        try:
+            self.client.update_item(TableName=self.table_name,
+                                    Key={'shard_id': {'S': shard_id}},
+                                    UpdateExpression='SET lease_owner = :owner, lease_expiry = :expiry',
+                                    ConditionExpression='attribute_not_exists(lease_owner) OR '
+                                                        'lease_owner = :owner OR lease_expiry < :now',
+                                    ExpressionAttributeValues={':owner': {'S': owner},
+                                                               ':expiry': {'N': str(now + duration)},
+                                                               ':now': {'N': str(now)}})
+        except self.client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    def release_lease(self, shard_id, owner):
+        try:
+            self.client.update_item(TableName=self.table_name,
+                                    Key={'shard_id': {'S': shard_id}},
+                                    UpdateExpression='REMOVE lease_owner, lease_expiry',
+                                    ConditionExpression='lease_owner = :owner',
+                                    ExpressionAttributeValues={':owner': {'S': owner}})
+        except self.client.exceptions.ConditionalCheckFailedException:
+            pass
+
+
+# Create a checkpointer which remembers the last processed record of each shard
+# and writes the checkpoints to the store every N records or T seconds
+class Checkpointer:
+
+    def __init__(self, store, owner=None, every_records=1000, every_seconds=10.0):
+        self.store = store
+        self.owner = owner
+        self.every_records = every_records
+        self.every_seconds = every_seconds
+        # The latest processed position of each shard which is not written to the store yet
+        self.pending = {}
+        self.pending_count = 0
+        self.last_write = time.time()
+        self.lock = threading.Lock()
+        # Only one flush writes to the store at a time, so an older checkpoint never overwrites a newer one
+        self.write_lock = threading.Lock()
+        # Shards whose lease was lost while writing a checkpoint
+        self.lost_shards = set()
+        # Shards with a record the processor failed on, their checkpoint stays before that record
+        self.held = set()
+
+    # Remember a processed record, writing the checkpoints once enough records or time have passed
+    def mark(self, shard_id, record):
+        with self.lock:
+            if shard_id in self.held:
+                return
+            self.pending[shard_id] = (record['SequenceNumber'], record.get('SubSequenceNumber'))
+            self.pending_count += 1
+            due = (self.pending_count >= self.every_records or
+                   time.time() - self.last_write >= self.every_seconds)
+        if due:
+            self.flush()
+
+    # Write the pending checkpoints once they are older than 'every_seconds', called regularly so the last
+    # checkpoint of a shard without new records is written too
+    def flush_due(self):
+        with self.lock:
+            due = self.pending and time.time() - self.last_write >= self.every_seconds
+        if due:
+            self.flush()
+
+    # Write the pending checkpoints to the store
+    def flush(self):
+        with self.write_lock:
+            with self.lock:
+                pending = self.pending
+                self.pending = {}
+                self.pending_count = 0
+                self.last_write = time.time()
+            for shard_id, (sequence_number, sub_sequence) in pending.items():
+                if not self.store.set_checkpoint(shard_id, sequence_number, sub_sequence, self.owner):
+                    self.lost_shards.add(shard_id)
+
+    # Stop advancing the checkpoint of a shard after a record failed, so the record is read again after a restart
+    def hold(self, shard_id):
+        with self.lock:
+            self.held.add(shard_id)
+
+    # Mark a closed shard as completely processed, unless one of its records failed
+    def shard_end(self, shard_id):
+        self.flush()
+        if shard_id in self.held:
+            return
+        with self.write_lock:
+            if not self.store.set_checkpoint(shard_id, SHARD_END, None, self.owner):
+                self.lost_shards.add(shard_id)
+
+
+# Create a poller which adapts the 'get_records' limit and the time between the calls on a shard
+#
+# - The limit is doubled every time a call returns as many records as asked for, up to 10,000,
+#   and halved every time a call is throttled, down to the minimum limit. After the first throttle
+#   it only grows by the minimum limit at a time, so it settles below the read throughput of the shard
+# - The wait between calls doubles on every empty response while the consumer is caught up
+# - The consumer polls as fast as the shard allows, 5 calls per second, while it is behind the tip of the stream
+# - A throttled call is retried after an exponential backoff with jitter
+class AdaptivePoller:
+
+    def __init__(self, min_limit=100, max_limit=10000, min_interval=0.2, max_interval=2.0,
+                 lag_threshold=1000, backoff=0.5, max_backoff=10.0):
+        self.min_limit = min(min_limit, max_limit)
+        self.max_limit = max_limit
+        self.limit = self.min_limit
+        # The limit doubles until the shard is throttled for the first time
+        self.slow_start = True
+        # Each shard allows 5 'get_records' calls per second, so 0.2 seconds is the shortest useful wait
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        # The consumer counts as behind once it is more than this many milliseconds behind the tip
+        self.lag_threshold = lag_threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        # Metrics of the poller
+        self.calls = 0
+        self.records = 0
+        self.empty_calls = 0
+        self.throttles = 0
+        self.millis_behind = 0
+
+    # Call 'get_records', retrying the call after a backoff while the shard is throttled
+    def get_records(self, client, iterator, stopped=None):
+        attempt = 0
+        while True:
+            try:
+                response = client.get_records(ShardIterator=iterator, Limit=self.limit)
+                break
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ProvisionedThroughputExceededException':
+                    raise
+                self.throttles += 1
+                # Ask for fewer records, a large response uses up the read throughput of the shard
+                self.limit = max(self.min_limit, self.limit // 2)
+                self.slow_start = False
+                delay = min(self.max_backoff, self.backoff * (2 ** attempt)) * random.uniform(0.5, 1.0)
+                attempt += 1
+                # Give up waiting once the consumer is stopped
+                if stopped is not None and stopped.wait(delay):
+                    return {'Records': [], 'NextShardIterator': iterator}
+                if stopped is None:
+                    time.sleep(delay)
+        self._adapt(response, throttled=attempt > 0)
+        return response
+
+    # Adapt the limit and the wait from a 'get_records' response
+    def _adapt(self, response, throttled=False):
+        count = len(response['Records'])
+        self.calls += 1
+        self.records += count
+        self.millis_behind = response.get('MillisBehindLatest', 0)
+        behind = self.millis_behind > self.lag_threshold
+        # Ask for more records when the response was full or the consumer is falling behind,
+        # but not right after the shard was throttled
+        if (count >= self.limit or behind) and not throttled:
+            grown = self.limit * 2 if self.slow_start else self.limit + self.min_limit
+            self.limit = min(self.max_limit, grown)
+        if count == 0 and not behind:
+            # Back off while there is nothing to read
+            self.empty_calls += 1
+            self.interval = min(self.max_interval, self.interval * 2)
+        else:
+            self.interval = self.min_interval
+
+    # Wait before the next call, returns True if the consumer was stopped while waiting
+    def wait(self, stopped=None):
+        if stopped is None:
+            time.sleep(self.interval)
+            return False
+        return stopped.wait(self.interval)
+
+    # Metrics about the polling of the shard
+    def metrics(self):
+        return {
+            'calls': self.calls,
+            'records': self.records,
+            'records_per_call': self.records / self.calls if self.calls else 0.0,
+            'empty_calls': self.empty_calls,
+            'throttles': self.throttles,
+            'millis_behind_latest': self.millis_behind,
+            'limit': self.limit,
+            'interval': self.interval
+        }
+
+
+# Create a worker thread which reads the records of a single shard into the processing queues
+class ShardWorker(threading.Thread):
+
+    def __init__(self, consumer, shard_id, iterator_type='LATEST'):
+        super().__init__(name='shard-' + shard_id, daemon=True)
+        self.consumer = consumer
+        self.shard_id = shard_id
+        self.iterator_type = iterator_type
+        # Number of user records read from the shard
+        self.record_count = 0
+        # Set when the worker has to stop reading, for example after losing the lease of the shard
+        self.stopped = threading.Event()
+        # The poller deciding how many records to ask for and how long to wait between the calls
+        self.poller = AdaptivePoller(max_limit=consumer.limit,
+                                     min_interval=consumer.poll_interval,
+                                     max_interval=consumer.max_poll_interval)
+        # Sequence number of the last kinesis record whose user records were all queued
+        self.last_sequence = None
+
+    # Get the first shard iterator, resuming after the checkpoint of the shard if there is one
+    def _first_iterator(self):
+        consumer = self.consumer
+        kwargs = {'StreamName': consumer.stream_name,
+                  'ShardId': self.shard_id,
+                  'ShardIteratorType': self.iterator_type}
+        # Position of an aggregated record whose user records were only partly processed
+        self.skip_until = None
+        checkpoint = consumer.store.get_checkpoint(self.shard_id) if consumer.store else None
+        if checkpoint:
+            sequence_number, sub_sequence = checkpoint
+            kwargs['StartingSequenceNumber'] = sequence_number
+            if sub_sequence is None:
+                kwargs['ShardIteratorType'] = 'AFTER_SEQUENCE_NUMBER'
+            else:
+                # Read the aggregated record again and skip the user records processed before the restart
+                kwargs['ShardIteratorType'] = 'AT_SEQUENCE_NUMBER'
+                self.skip_until = checkpoint
+        return consumer.client.get_shard_iterator(**kwargs)['ShardIterator']
+
+    # Check whether a user record was already processed before the consumer was restarted
+    def _already_processed(self, record):
+        sequence_number, sub_sequence = self.skip_until
+        if record['SequenceNumber'] == sequence_number and record.get('SubSequenceNumber', 0) <= sub_sequence:
+            return True
+        self.skip_until = None
+        return False
+
+    # Get a shard iterator after the last record read, or from the checkpoint before the first one
+    def _iterator(self):
+        if self.last_sequence is None:
+            return self._first_iterator()
+        self.skip_until = None
+        return self.consumer.client.get_shard_iterator(StreamName=self.consumer.stream_name,
+                                                       ShardId=self.shard_id,
+                                                       ShardIteratorType='AFTER_SEQUENCE_NUMBER',
+                                                       StartingSequenceNumber=self.last_sequence)['ShardIterator']
+
+    def run(self):
+        consumer = self.consumer
+        iterator = None
+        failures = 0
+        while not consumer.stopped.is_set() and not self.stopped.is_set():
+            try:
+                if iterator is None:
+                    iterator = self._iterator()
+                response = self.poller.get_records(consumer.client, iterator, consumer.stopped)
+            except (ClientError, BotoCoreError) as e:
+                # An expired iterator or a failed call, try again with a new iterator after a backoff with jitter
+                failures += 1
+                delay = min(self.poller.max_backoff, self.poller.backoff * (2 ** (failures - 1))) * random.uniform(0.5, 1.0)
+                print('Could not read shard {}, retrying in {:.1f}s: {}'.format(self.shard_id, delay, e))
+                iterator = None
+                if consumer.stopped.wait(delay):
+                    return
+                continue
+            failures = 0
+            for user_record in deaggregate_records(response['Records']):
+                if self.skip_until and self._already_processed(user_record):
+                    continue
+                # Blocks while the processing queue is full, so a slow pipeline slows down the reading
+                if not consumer.submit(self.shard_id, user_record):
+                    return
+                self.record_count += 1
+            if response['Records']:
+                self.last_sequence = response['Records'][-1]['SequenceNumber']
+            iterator = response.get('NextShardIterator')
+            # A shard without a next iterator was closed by a split or merge and is now read completely
+            if iterator is None:
+                self._end_shard()
+                return
+            # Wait before asking again, for longer while the shard has no new records
+            if self.poller.wait(consumer.stopped):
+                return
+
+    # Mark the shard as ended and start its children, retrying after a backoff with jitter when
+    # the checkpoint or the listing of the shards fails, otherwise the children would never be read
+    def _end_shard(self):
+        consumer = self.consumer
+        failures = 0
+        while not consumer.stopped.is_set() and not self.stopped.is_set():
+            try:
+                consumer.shard_ended(self.shard_id)
+                return
+            except (ClientError, BotoCoreError) as e:
+                failures += 1
+                delay = min(self.poller.max_backoff, self.poller.backoff * (2 ** (failures - 1))) * random.uniform(0.5, 1.0)
+                print('Could not end shard {}, retrying in {:.1f}s: {}'.format(self.shard_id, delay, e))
+                if consumer.stopped.wait(delay):
+                    return
+
+
+# Create a consumer which runs a worker per shard and a pool of threads processing the records
+class StreamConsumer:
+
+    def __init__(self, stream_name, processor, client=None, processing_threads=4,
+                 queue_size=10000, limit=10000, poll_interval=0.2, max_poll_interval=2.0, iterator_type='LATEST',
+                 store=None, owner=None, lease_duration=30.0, checkpoint_records=1000, checkpoint_seconds=10.0):
+        self.stream_name = stream_name
+        # The function called with the shard id and each user record
+        self.processor = processor
+        # Use the module's kinesis client if no client is passed in
+        self.client = client or kinesis_client
+        # Maximum number of records asked for in a single 'get_records' call
+        self.limit = limit
+        # Shortest and longest time in seconds between two 'get_records' calls on a shard
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.iterator_type = iterator_type
+        # One bounded queue per processing thread, the records of a shard always go to the same queue to keep their order
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(processing_threads)]
+        self.stopped = threading.Event()
+        self.workers = {}
+        self.processors = []
+        # Number of records processed and the errors raised by the processor
+        self.processed_count = 0
+        self.errors = []
+        self.count_lock = threading.Lock()
+        # The checkpoint and lease store, without a store the consumer neither checkpoints nor leases shards
+        self.store = store
+        # Unique name of this consumer used as the owner of its leases
+        self.owner = owner or str(uuid4())
+        self.lease_duration = lease_duration
+        self.checkpointer = None
+        if store is not None:
+            self.checkpointer = Checkpointer(store, self.owner, checkpoint_records, checkpoint_seconds)
+        # All the shards of the stream, including the ones leased by other consumers
+        self.shard_ids = []
+        self.shards = {}
+        self.lease_thread = None
+        # Shards read completely, their children can be read now
+        self.finished = set()
+        # Closed shards which were skipped because the consumer started at the latest records
+        self.skipped = set()
+        # Number of records of each shard which are queued but not processed yet
+        self.in_flight = Counter()
+        self.shard_lock = threading.RLock()
+
+    # Put a record into the processing queue of its shard, returns False once the consumer is stopped
+    def submit(self, shard_id, record):
+        q = self.queues[hash(shard_id) % len(self.queues)]
+        with self.count_lock:
+            self.in_flight[shard_id] += 1
+        while not self.stopped.is_set():
+            try:
+                q.put((shard_id, record), timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    # Take the records from a queue and pass them to the processor
+    def _process_loop(self, q):
+        while not (self.stopped.is_set() and q.empty()):
+            try:
+                shard_id, record = q.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            try:
+                self.processor(shard_id, record)
+                # Checkpoint the record once it is processed, the checkpointer batches the writes
+                if self.checkpointer:
+                    self.checkpointer.mark(shard_id, record)
+            except Exception as e:
+                self.errors.append((shard_id, record, e))
+                # The checkpoint of the shard stays before the failed record, which is read again after a restart
+                if self.checkpointer:
+                    self.checkpointer.hold(shard_id)
+            with self.count_lock:
+                self.processed_count += 1
+                self.in_flight[shard_id] -= 1
+            q.task_done()
+
+    # Check whether all the parents of a shard are read completely, by this or another consumer
+    def _parents_finished(self, shard):
+        for parent_id in (shard.get('ParentShardId'), shard.get('AdjacentParentShardId')):
+            # Parents which are no longer in the stream have expired after the retention period
+            if parent_id is None or parent_id not in self.shards or parent_id in self.finished or parent_id in self.skipped:
+                continue
+            if self.store and self.store.get_checkpoint(parent_id) == (SHARD_END, None):
+                self.finished.add(parent_id)
+                continue
+            return False
+        return True
+
+    # Start a worker for a shard unless it is already being read, its parents are not read yet
+    # or another consumer holds its lease
+    def start_shard(self, shard_id):
+        with self.shard_lock:
+            worker = self.workers.get(shard_id)
+            if (worker and worker.is_alive()) or shard_id in self.finished or shard_id in self.skipped:
+                return
+            shard = self.shards.get(shard_id, {})
+            # Keep the order across a split or merge by reading the children only after their parents
+            if not self._parents_finished(shard):
+                return
+            if self.store and not self.store.acquire_lease(shard_id, self.owner, self.lease_duration):
+                return
+            if self.store and self.store.get_checkpoint(shard_id) == (SHARD_END, None):
+                self.finished.add(shard_id)
+                self.store.release_lease(shard_id, self.owner)
+                return
+            # A child of a parent read by the consumer starts at its first record, so none of its records are missed
+            iterator_type = self.iterator_type
+            parents = [shard.get('ParentShardId'), shard.get('AdjacentParentShardId')]
+            if any(parent in self.shards and parent not in self.skipped for parent in parents):
+                iterator_type = 'TRIM_HORIZON'
+            worker = ShardWorker(self, shard_id, iterator_type)
+            self.workers[shard_id] = worker
+            worker.start()
+
+    # Read the shards of the stream again and start the ones which can be read now
+    def refresh_shards(self):
+        shards = list_all_shards(self.stream_name, self.client)
+        with self.shard_lock:
+            self.shards = {shard['ShardId']: shard for shard in shards}
+            self.shard_ids = [shard['ShardId'] for shard in shards]
+        for shard_id in self.shard_ids:
+            self.start_shard(shard_id)
+
+    # Called by a worker once its closed shard is read completely, starts the children of the shard
+    def shard_ended(self, shard_id):
+        # Wait until the records of the shard are processed, so no child record is processed before them
+        while self.in_flight[shard_id] > 0:
+            if self.stopped.wait(0.05):
+                return
+        if self.store:
+            self.checkpointer.shard_end(shard_id)
+        with self.shard_lock:
+            self.finished.add(shard_id)
+        # The children of the shard may be new, so the shards are listed again
+        self.refresh_shards()
+
+    # Start the processing threads and a worker for every shard of the stream
+    def start(self):
+        for q in self.queues:
+            thread = threading.Thread(target=self._process_loop, args=(q,), daemon=True)
+            thread.start()
+            self.processors.append(thread)
+        shards = list_all_shards(self.stream_name, self.client)
+        with self.shard_lock:
+            self.shards = {shard['ShardId']: shard for shard in shards}
+            self.shard_ids = [shard['ShardId'] for shard in shards]
+            # Starting at the latest records, the closed shards have nothing new to read
+            if self.iterator_type == 'LATEST':
+                for shard in shards:
+                    closed = 'EndingSequenceNumber' in shard.get('SequenceNumberRange', {})
+                    if closed and not (self.store and self.store.get_checkpoint(shard['ShardId'])):
+                        self.skipped.add(shard['ShardId'])
+        for shard_id in self.shard_ids:
+            self.start_shard(shard_id)
+        if self.store:
+            self.lease_thread = threading.Thread(target=self._lease_loop, daemon=True)
+            self.lease_thread.start()
+
+    # Renew the leases held by this consumer and take over the shards whose leases expired,
+    # a worker which died on an unexpected error is started again from the checkpoint of its shard.
+    # The checkpoints waiting for more records are written here once they are due
+    def _lease_loop(self):
+        while not self.stopped.wait(self.lease_duration / 3):
+            try:
+                self.checkpointer.flush_due()
+            except (ClientError, BotoCoreError) as e:
+                print('Could not write the checkpoints: {}'.format(e))
+            for shard_id, worker in list(self.workers.items()):
+                if not worker.is_alive():
+                    continue
+                # Stop reading a shard once another consumer has taken over its lease
+                if shard_id in self.checkpointer.lost_shards or \
+                        not self.store.acquire_lease(shard_id, self.owner, self.lease_duration):
+                    worker.stopped.set()
+                    self.checkpointer.lost_shards.discard(shard_id)
+                    with self.shard_lock:
+                        del self.workers[shard_id]
+            for shard_id in self.shard_ids:
+                worker = self.workers.get(shard_id)
+                if worker is None or not worker.is_alive():
+                    self.start_shard(shard_id)
+
+    # Stop reading the shards and wait for the queued records to be processed
+    def stop(self):
+        self.stopped.set()
+        for worker in list(self.workers.values()):
+            worker.join()
+        for thread in self.processors:
+            thread.join()
+        if self.store:
+            if self.lease_thread:
+                self.lease_thread.join()
+            # Write the last checkpoints and hand the shards over to the other consumers
+            self.checkpointer.flush()
+            for shard_id in self.workers:
+                self.store.release_lease(shard_id, self.owner)
+
+    # Metrics of the consumer, including the lag and the records per call of every shard
+    def metrics(self):
+        shards = {shard_id: worker.poller.metrics() for shard_id, worker in list(self.workers.items())}
+        return {
+            'processed': self.processed_count,
+            'errors': len(self.errors),
+            'queued': sum(q.qsize() for q in self.queues),
+            'max_millis_behind_latest': max([m['millis_behind_latest'] for m in shards.values()] or [0]),
+            'shards': shards
+        }
+
+    # Run the consumer until all the shards are read completely or it is interrupted
+    def run(self):
+        self.start()
+        try:
+            # With a lease store the consumer keeps running to take over the shards released by other consumers
+            while self.store or any(worker.is_alive() for worker in list(self.workers.values())):
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        self.stop()
+
+
+# Create the statistics of a window: count, sum, minimum, maximum and a histogram for the percentiles
+# The histogram has a fixed number of buckets between 'low' and 'high', so a window takes the same
+# memory no matter how many readings fall into it and the percentiles are exact up to a bucket width
+class WindowStats:
+    __slots__ = ('count', 'total', 'minimum', 'maximum', 'low', 'width', 'histogram')
+
+    def __init__(self, low=0, high=256, buckets=256):
+        self.count = 0
+        self.total = 0
+        self.minimum = None
+        self.maximum = None
+        self.low = low
+        self.width = (high - low) / buckets
+        self.histogram = [0] * buckets
+
+    # Add a reading to the window
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+        # Readings outside the range are counted in the first or the last bucket
+        bucket = int((value - self.low) / self.width)
+        self.histogram[min(max(bucket, 0), len(self.histogram) - 1)] += 1
+
+    # Add the readings of another window with the same buckets
+    def merge(self, other):
+        if not other.count:
+            return
+        self.count += other.count
+        self.total += other.total
+        self.minimum = other.minimum if self.minimum is None else min(self.minimum, other.minimum)
+        self.maximum = other.maximum if self.maximum is None else max(self.maximum, other.maximum)
+        self.histogram = [a + b for a, b in zip(self.histogram, other.histogram)]
+
+    # The value below which the given percentage of the readings fall, the lower edge of its bucket
+    def percentile(self, percent):
+        rank = percent / 100.0 * self.count
+        seen = 0
+        for bucket, count in enumerate(self.histogram):
+            seen += count
+            if count and seen >= rank:
+                value = self.low + bucket * self.width
+                # Keep the percentile inside the readings actually seen
+                return min(max(value, self.minimum), self.maximum)
+        return self.maximum
+
+
+# Create a stage aggregating the readings of each thing over windows of event time
+#
+# - 'size' is the length of a window in seconds, 'slide' how often a window starts,
+#   a window is tumbling when the slide is the size and sliding when the slide is shorter
+# - The readings are kept in panes of 'slide' seconds, a sliding window merges its panes when it is emitted.
+#   Panes and windows are counted by the number of the pane, so timestamps and slides can be floats
+# - The watermark is the latest event time seen minus 'allowed_lateness', a window is emitted once
+#   the watermark passes its end and readings for windows already emitted are dropped as late
+class WindowAggregator:
+
+    def __init__(self, size, slide=None, emit=print, allowed_lateness=0, value_field='prop',
+                 time_field='timestamp', percentiles=(50, 90, 99), low=0, high=256, buckets=256):
+        self.size = size
+        self.slide = slide or size
+        # The number of panes in a window, compared with a tolerance as 0.3 / 0.1 is not exactly 3
+        self.window_panes = int(round(self.size / self.slide))
+        if self.window_panes < 1 or abs(self.window_panes * self.slide - self.size) > 1e-9 * self.size:
+            raise ValueError('The window size must be a multiple of the slide')
+        # The function called with the aggregates of every emitted window
+        self.emit = emit
+        self.allowed_lateness = allowed_lateness
+        self.value_field = value_field
+        self.time_field = time_field
+        self.percentiles = percentiles
+        self.histogram = (low, high, buckets)
+        # The panes of every thing and the first pane of the next window to emit for it
+        self.panes = {}
+        self.next_window = {}
+        self.watermark = None
+        self.late_count = 0
+        self.lock = threading.Lock()
+
+    # Processor for the stream consumer, decodes the record and adds its reading under the partition key
+    def process(self, shard_id, record):
+        payload = Codec.decode(record['Data'])
+        # Records written before the codecs are plain JSON and come back as bytes
+        if isinstance(payload, (bytes, bytearray)):
+            payload = json.loads(payload)
+        self.add(record['PartitionKey'], payload[self.time_field], payload[self.value_field])
 
-# Get the shard id of the shard from which we receive the data 
-my_shard_id = response['StreamDescription']['Shards'][0]['ShardId']
+    # Add a reading of a thing, emitting the windows the watermark has passed
+    def add(self, thing_id, timestamp, value):
+        pane = int(timestamp // self.slide)
+        with self.lock:
+            # The windows holding the pane are already emitted
+            if pane < self.next_window.get(thing_id, pane):
+                self.late_count += 1
+                return
+            panes = self.panes.setdefault(thing_id, {})
+            stats = panes.get(pane)
+            if stats is None:
+                stats = panes[pane] = WindowStats(*self.histogram)
+                # The first window of a thing is the earliest one holding its first pane
+                self.next_window.setdefault(thing_id, pane - self.window_panes + 1)
+            stats.add(value)
+            watermark = timestamp - self.allowed_lateness
+            # Windows can only end on a pane boundary, so the windows are only checked when the watermark crosses one
+            if self.watermark is None or watermark // self.slide > self.watermark // self.slide:
+                self.watermark = watermark
+                self._advance(watermark)
+            elif watermark > self.watermark:
+                self.watermark = watermark
 
-# Get the shard iterator response 
-shard_iterator = kinesis_client.get_shard_iterator(StreamName=stream_name, # Stream name
-                                                      ShardId=my_shard_id, # Shard id
-                                                      ShardIteratorType='LATEST') # Iterator type, here it is the latest records
+    # Emit the windows of every thing ending at or before the watermark
+    def _advance(self, watermark):
+        for thing_id in list(self.panes):
+            self._advance_thing(thing_id, watermark)
 
-# Get the shard iterator to point to the records
-my_shard_iterator = shard_iterator['ShardIterator']
+    def _advance_thing(self, thing_id, watermark):
+        panes = self.panes[thing_id]
+        start = self.next_window[thing_id]
+        while panes and (start + self.window_panes) * self.slide <= watermark:
+            stats = WindowStats(*self.histogram)
+            for pane in range(start, start + self.window_panes):
+                if pane in panes:
+                    stats.merge(panes[pane])
+            if stats.count:
+                self.emit(self._result(thing_id, start, stats))
+            start += 1
+            # Drop the panes which are in no window still to come
+            for pane in [pane for pane in panes if pane < start]:
+                del panes[pane]
+            # Jump over the windows without any reading
+            if panes:
+                start = max(start, min(panes) - self.window_panes + 1)
+        self.next_window[thing_id] = start
+        if not panes:
+            del self.panes[thing_id]
 
-# Get the records response from the stream
-record_response = kinesis_client.get_records(ShardIterator=my_shard_iterator,
-                                              Limit=2)
+    # Build the aggregates of a window starting with the given pane
+    def _result(self, thing_id, start, stats):
+        result = {
+            'thing_id': thing_id,
+            'window_start': start * self.slide,
+            'window_end': (start + self.window_panes) * self.slide,
+            'count': stats.count,
+            'min': stats.minimum,
+            'max': stats.maximum,
+            'mean': stats.total / stats.count
+        }
+        for percent in self.percentiles:
+            result['p{}'.format(percent)] = stats.percentile(percent)
+        return result
 
-# Loop over untill 'NextShardIterator' is available
-while 'NextShardIterator' in record_response:
-    # Get the records continuously from the stream
-    record_response = kinesis_client.get_records(ShardIterator=record_response['NextShardIterator'],
-                                                  Limit=2)
-    print(record_response)
+    # Emit all the windows still open, for example when the consumer stops
+    def flush(self):
+        with self.lock:
+            for thing_id in list(self.panes):
+                self._advance_thing(thing_id, float('inf'))
 
 
-# In[ ]:
+# Print a record received from the stream, the payload is decoded with the codec named in its header
+def print_record(shard_id, record):
+    print(shard_id, record['PartitionKey'], Codec.decode(record['Data']))
 
 
+if __name__ == '__main__':
+    # Keep the checkpoints and leases in a dynamodb table named after the stream
+    store = DynamoDBCheckpointStore(stream_name + '-checkpoints')
+    store.create_table()
 
+    # Aggregate the readings of each thing over one minute windows sliding every ten seconds
+    aggregator = WindowAggregator(60, slide=10, allowed_lateness=5, emit=print)
 
+    # Read all the shards of the stream in parallel and aggregate the records, resuming from the checkpoints
+    consumer = StreamConsumer(stream_name, aggregator.process, store=store)
+    consumer.run()
+    # Emit the windows still open after the consumer stopped
+    aggregator.flush()
@@ -9,15 +9,30 @@
 An example to send data over AWS Kinesis stream
 by creating a stream and defining the shards
 
+- Buffering the records and sending them in batches with 'put_records'
+- Retrying only the records that failed inside a batch
+- Aggregating many small user records into one kinesis record in the KPL format
+- Routing the records across all the shards using their hash key ranges
+- Producing from asyncio code with a bounded number of requests in flight
+- Encoding the payloads with a compact binary codec
+
 """
 
 # Import necessary packages
 import boto3
-import json
+from botocore.exceptions import ClientError, BotoCoreError
 from datetime import datetime
 import calendar
 import random
 import time
+import threading
+import hashlib
+import bisect
+import itertools
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import Codec
 
 # Create a boto3 session and get the current region
 session = boto3.session.Session()
@@ -27,34 +42,629 @@ region_name = session.region_name
 kinesis = boto3.client('kinesis', region_name=region_name)
 
 stream_name = 'new_stream'
-# Create a kinesis stream with the stream name and the number of required shards
-stream_create = kinesis.create_stream(StreamName=stream_name, ShardCount=1)
-print(stream_create)
+
+# Limits of a single 'put_records' call set by kinesis
+MAX_BATCH_RECORDS = 500              # At most 500 records in a request
+MAX_BATCH_BYTES = 5 * 1024 * 1024    # At most 5 MB of data and partition keys in a request
+MAX_RECORD_BYTES = 1024 * 1024       # At most 1 MB for a single record
+
+# Magic bytes at the start of a record aggregated in the format of the Kinesis Producer Library (KPL)
+KPL_MAGIC = b'\xf3\x89\x9a\xc2'
+# The default size of an aggregated record, the same as the KPL's 'AggregationMaxSize'
+AGGREGATION_MAX_BYTES = 51200
+
+
+# Encode an unsigned integer as a protobuf varint
+def _varint(value):
+    out = bytearray()
+    while True:
+        bits = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(bits | 0x80)
+        else:
+            out.append(bits)
+            return bytes(out)
+
+
+# Encode a protobuf field which is a length delimited value (strings, bytes and messages)
+def _field_bytes(field_number, value):
+    return _varint(field_number << 3 | 2) + _varint(len(value)) + value
+
+
+# Encode a protobuf field which is a varint value
+def _field_varint(field_number, value):
+    return _varint(field_number << 3) + _varint(value)
+
+
+# Create an aggregator which packs user records into the protobuf 'AggregatedRecord' message of the KPL
+#
+#   message AggregatedRecord {
+#       repeated string partition_key_table     = 1;
+#       repeated string explicit_hash_key_table = 2;
+#       repeated Record records                 = 3;
+#   }
+#   message Record {
+#       required uint64 partition_key_index     = 1;
+#       optional uint64 explicit_hash_key_index = 2;
+#       required bytes  data                    = 3;
+#   }
+#
+# The kinesis record is the magic bytes, the protobuf message and the md5 digest of the message
+class RecordAggregator:
+
+    def __init__(self, max_bytes=AGGREGATION_MAX_BYTES):
+        self.max_bytes = min(max_bytes, MAX_RECORD_BYTES)
+        self.clear()
+
+    # Reset the aggregator to hold no records
+    def clear(self):
+        # Tables of the distinct keys, a record refers to its keys by the index in the table
+        self.partition_keys = {}
+        self.explicit_hash_keys = {}
+        # The encoded protobuf fields for the key tables and the records
+        self.key_fields = []
+        self.record_fields = []
+        # The partition key and explicit hash key of the aggregated kinesis record itself
+        self.partition_key = None
+        self.explicit_hash_key = None
+        # Size of the complete kinesis record: magic bytes, message and the 16 bytes md5 digest
+        self.size = len(KPL_MAGIC) + 16
+
+    def __len__(self):
+        return len(self.record_fields)
+
+    # Find the index of a key in the table or compute the new fields if the key is not there yet
+    def _key_index(self, table, field_number, key):
+        if key in table:
+            return table[key], b''
+        return len(table), _field_bytes(field_number, key.encode('utf-8'))
+
+    # Encode a user record against the given key tables, returning the record field and the new key table fields
+    def _encode(self, data, partition_key, explicit_hash_key, partition_keys, explicit_hash_keys):
+        pk_index, pk_field = self._key_index(partition_keys, 1, partition_key)
+        record = _field_varint(1, pk_index)
+        ehk_field = b''
+        if explicit_hash_key is not None:
+            ehk_index, ehk_field = self._key_index(explicit_hash_keys, 2, explicit_hash_key)
+            record += _field_varint(2, ehk_index)
+        record += _field_bytes(3, data)
+        return _field_bytes(3, record), pk_field, ehk_field
+
+    # Add a user record, returns the completed aggregated record if the new record did not fit into it
+    def add(self, data, partition_key, explicit_hash_key=None):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        completed = None
+        record, pk_field, ehk_field = self._encode(data, partition_key, explicit_hash_key,
+                                                   self.partition_keys, self.explicit_hash_keys)
+        added = len(record) + len(pk_field) + len(ehk_field)
+        if self.record_fields and self.size + added > self.max_bytes:
+            # The record starts a new aggregated record of its own, encoded against empty key tables
+            record, pk_field, ehk_field = self._encode(data, partition_key, explicit_hash_key, {}, {})
+            added = len(record) + len(pk_field) + len(ehk_field)
+            # Check the size before handing back the full aggregated record, so that it is not lost with the error
+            if len(KPL_MAGIC) + 16 + added > MAX_RECORD_BYTES:
+                raise ValueError('Record of {} bytes is above the 1 MB limit'.format(len(data)))
+            completed = self.drain()
+        if self.size + added > MAX_RECORD_BYTES:
+            raise ValueError('Record of {} bytes is above the 1 MB limit'.format(len(data)))
+        if pk_field:
+            self.partition_keys[partition_key] = len(self.partition_keys)
+            self.key_fields.append(pk_field)
+        if ehk_field:
+            self.explicit_hash_keys[explicit_hash_key] = len(self.explicit_hash_keys)
+            self.key_fields.append(ehk_field)
+        # The aggregated record is routed by the keys of its first user record
+        if self.partition_key is None:
+            self.partition_key = partition_key
+            self.explicit_hash_key = explicit_hash_key
+        self.record_fields.append(record)
+        self.size += added
+        return completed
+
+    # Build the aggregated kinesis record from the records added so far and reset the aggregator
+    def drain(self):
+        if not self.record_fields:
+            return None
+        message = b''.join(self.key_fields) + b''.join(self.record_fields)
+        record = {
+            'Data': KPL_MAGIC + message + hashlib.md5(message).digest(),
+            'PartitionKey': self.partition_key
+        }
+        if self.explicit_hash_key is not None:
+            record['ExplicitHashKey'] = self.explicit_hash_key
+        self.clear()
+        return record
+
+
+# Function to aggregate a list of (data, partition key) pairs into as few kinesis records as possible
+# An aggregated record is routed by the key of its first user record, so only records of the same key are packed together
+def aggregate_records(records, max_bytes=AGGREGATION_MAX_BYTES):
+    aggregators = {}
+    aggregated = []
+    for data, partition_key in records:
+        aggregator = aggregators.get(partition_key)
+        if aggregator is None:
+            aggregator = aggregators[partition_key] = RecordAggregator(max_bytes)
+        completed = aggregator.add(data, partition_key)
+        if completed:
+            aggregated.append(completed)
+    for aggregator in aggregators.values():
+        last = aggregator.drain()
+        if last:
+            aggregated.append(last)
+    return aggregated
+
+
+# Create a router which caches the hash key ranges of the open shards and spreads the records across them
+#
+# Kinesis maps a record to the shard whose hash key range holds the md5 hash of its partition key,
+# so a single partition key always ends up on a single shard. The router can instead give every record
+# an explicit hash key inside the range of the next shard, spreading the records evenly over the shards.
+# Records which have to stay in order are routed by their partition key as kinesis would do.
+class ShardRouter:
+
+    def __init__(self, stream_name, client=None, refresh_interval=60.0):
+        self.stream_name = stream_name
+        # Use the module's kinesis client if no client is passed in
+        self.client = client or kinesis
+        # Time in seconds after which the shard map is read again to notice resharding
+        self.refresh_interval = refresh_interval
+        self.lock = threading.Lock()
+        self.shard_ids = []
+        self.starting_keys = []
+        self.hash_keys = {}
+        self.refreshed = 0
+        self.round_robin = itertools.count()
+
+    # Read the hash key ranges of the open shards of the stream
+    def refresh(self):
+        shards = []
+        response = self.client.list_shards(StreamName=self.stream_name)
+        shards.extend(response['Shards'])
+        while response.get('NextToken'):
+            response = self.client.list_shards(NextToken=response['NextToken'])
+            shards.extend(response['Shards'])
+        # Closed shards, the parents of a split or merge, have an ending sequence number and take no new records
+        ranges = []
+        for shard in shards:
+            if 'EndingSequenceNumber' in shard.get('SequenceNumberRange', {}):
+                continue
+            start = int(shard['HashKeyRange']['StartingHashKey'])
+            end = int(shard['HashKeyRange']['EndingHashKey'])
+            ranges.append((start, end, shard['ShardId']))
+        ranges.sort()
+        with self.lock:
+            self.shard_ids = [shard_id for _, _, shard_id in ranges]
+            self.starting_keys = [start for start, _, _ in ranges]
+            # The middle of the range is used as the explicit hash key of a shard
+            self.hash_keys = {shard_id: str((start + end) // 2) for start, end, shard_id in ranges}
+            self.refreshed = time.time()
+
+    # Check whether the shard map has to be read again
+    def stale(self):
+        return not self.shard_ids or time.time() - self.refreshed >= self.refresh_interval
+
+    # Refresh the shard map when it is older than the refresh interval
+    def _check(self):
+        if self.stale():
+            self.refresh()
+
+    # Mark the shard map as stale, for example after a record was put into a shard it does not know
+    def invalidate(self):
+        self.refreshed = 0
+
+    # Check whether a shard id is one of the open shards in the map
+    def knows(self, shard_id):
+        return shard_id in self.hash_keys
+
+    # Find the shard holding a hash key
+    def shard_for_hash(self, hash_key):
+        self._check()
+        with self.lock:
+            return self.shard_ids[bisect.bisect_right(self.starting_keys, hash_key) - 1]
+
+    # Find the shard kinesis puts a partition key into
+    def shard_for_key(self, partition_key):
+        return self.shard_for_hash(int(hashlib.md5(partition_key.encode('utf-8')).hexdigest(), 16))
+
+    # The explicit hash key sending a record to the given shard
+    def hash_key(self, shard_id):
+        return self.hash_keys.get(shard_id)
+
+    # Pick the shard for a record, returns the shard id and the explicit hash key to put the record with
+    def route(self, partition_key, ordered=False):
+        # Records of the same partition key stay in order on the shard of their key
+        if ordered:
+            return self.shard_for_key(partition_key), None
+        self._check()
+        with self.lock:
+            shard_id = self.shard_ids[next(self.round_robin) % len(self.shard_ids)]
+            return shard_id, self.hash_keys[shard_id]
+
+
+# Create a producer which buffers the records and sends them as batches with 'put_records'
+class BatchProducer:
+
+    def __init__(self, stream_name, client=None, max_records=MAX_BATCH_RECORDS,
+                 max_bytes=MAX_BATCH_BYTES, linger=0.1, max_retries=5, backoff=0.1, aggregate=False,
+                 aggregation_max_bytes=AGGREGATION_MAX_BYTES, router=None):
+        self.stream_name = stream_name
+        # Use the module's kinesis client if no client is passed in
+        self.client = client or kinesis
+        self.max_records = min(max_records, MAX_BATCH_RECORDS)
+        self.max_bytes = min(max_bytes, MAX_BATCH_BYTES)
+        # The maximum time in seconds a record waits in the buffer before being sent
+        self.linger = linger
+        # The number of times a failed record is sent again before giving up
+        self.max_retries = max_retries
+        # The base delay in seconds between retries, doubled on every retry
+        self.backoff = backoff
+        # The records waiting to be sent and their total size in bytes
+        self.buffer = []
+        self.buffer_bytes = 0
+        # Lock guarding the buffer and a second lock so only one batch is sent at a time to keep the order
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.last_flush = time.time()
+        # Counters for the records sent, failed and the number of 'put_records' calls
+        self.sent_count = 0
+        self.failed_count = 0
+        self.request_count = 0
+        # Records which failed even after all the retries
+        self.failed_records = []
+        # Pack the user records into aggregated kinesis records before buffering if aggregation is enabled.
+        # All the records packed together go to the same shard, with a router there is an aggregator per shard
+        # and without one an aggregator per explicit hash key or partition key, as the shard map is unknown
+        self.aggregate = aggregate
+        self.aggregation_max_bytes = aggregation_max_bytes
+        self.aggregators = {}
+        self.aggregate_lock = threading.Lock()
+        # The router spreading the records over the shards, without a router the records go by their partition key
+        self.router = router
+        # Start a background thread which flushes the buffer once the linger time has passed
+        self.closed = threading.Event()
+        self.flusher = threading.Thread(target=self._linger_loop, daemon=True)
+        self.flusher.start()
+
+    # Add a record to the producer, it is sent as part of a batch
+    # With a router the records are spread over the shards unless 'ordered' asks to keep the order of the partition key
+    def put(self, data, partition_key, explicit_hash_key=None, ordered=False):
+        if self.closed.is_set():
+            raise RuntimeError('Producer is closed')
+        # Kinesis expects the data as bytes
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        shard_id = None
+        if self.router is not None and explicit_hash_key is None:
+            shard_id, explicit_hash_key = self.router.route(partition_key, ordered)
+        if self.aggregate:
+            # The aggregator hands back a kinesis record only once it is full
+            group = shard_id if shard_id is not None else ('hash', explicit_hash_key) if explicit_hash_key is not None \
+                else ('key', partition_key)
+            with self.aggregate_lock:
+                aggregator = self.aggregators.get(group)
+                if aggregator is None:
+                    aggregator = self.aggregators[group] = RecordAggregator(self.aggregation_max_bytes)
+                # The routed shard is set on the aggregated record, the user records need no hash key of their own
+                record = aggregator.add(data, partition_key, None if shard_id else explicit_hash_key)
+            if record:
+                self._enqueue(self._route_aggregated(shard_id, record))
+            return
+        record = {'Data': data, 'PartitionKey': partition_key}
+        # An explicit hash key decides the shard directly instead of hashing the partition key
+        if explicit_hash_key is not None:
+            record['ExplicitHashKey'] = explicit_hash_key
+        self._enqueue(record)
+
+    # Send an aggregated record to the shard its user records were routed to
+    def _route_aggregated(self, shard_id, record):
+        if self.router is not None and self.router.hash_key(shard_id) is not None:
+            record['ExplicitHashKey'] = self.router.hash_key(shard_id)
+        return record
+
+    # Add a kinesis record to the buffer, flushing first if the record would not fit into the batch
+    def _enqueue(self, record):
+        # The size of a record counts both the data and the partition key
+        size = len(record['Data']) + len(record['PartitionKey'].encode('utf-8'))
+        if size > MAX_RECORD_BYTES:
+            raise ValueError('Record of {} bytes is above the 1 MB limit'.format(size))
+        with self.lock:
+            full = (len(self.buffer) + 1 > self.max_records or
+                    self.buffer_bytes + size > self.max_bytes)
+            if full:
+                batch = self._drain()
+            self.buffer.append(record)
+            self.buffer_bytes += size
+        if full:
+            self._send(batch)
+        # Flush right away once the batch is completely filled
+        if len(self.buffer) >= self.max_records:
+            self.flush()
+
+    # Take all the records out of the buffer, must be called holding the lock
+    def _drain(self):
+        batch = self.buffer
+        self.buffer = []
+        self.buffer_bytes = 0
+        self.last_flush = time.time()
+        return batch
+
+    # Send all the records in the buffer
+    def flush(self):
+        # Move the partly filled aggregated records into the buffer first
+        if self.aggregate:
+            with self.aggregate_lock:
+                records = [(group, aggregator.drain()) for group, aggregator in self.aggregators.items()]
+                # Without a router there is an aggregator per key, forget the drained ones so they do not pile up
+                self.aggregators = {}
+            for group, record in records:
+                if record:
+                    self._enqueue(self._route_aggregated(group, record))
+        with self.lock:
+            batch = self._drain()
+        if batch:
+            self._send(batch)
+
+    # Send a batch with 'put_records' and retry only the entries that failed
+    # A failure of the whole request, like a throttled or dropped call, sends all the entries again
+    def _send(self, batch):
+        with self.send_lock:
+            entries = batch
+            attempt = 0
+            while entries:
+                self.request_count += 1
+                try:
+                    response = self.client.put_records(StreamName=self.stream_name, Records=entries)
+                except (ClientError, BotoCoreError) as e:
+                    print('Could not put {} records: {}'.format(len(entries), e))
+                    retry = entries
+                else:
+                    # The results are in the same order as the records sent
+                    retry = []
+                    for entry, result in zip(entries, response['Records']):
+                        if 'ErrorCode' in result:
+                            retry.append(entry)
+                        # A record landing on a shard the router does not know means the stream was resharded
+                        elif self.router is not None and not self.router.knows(result.get('ShardId')):
+                            self.router.invalidate()
+                self.sent_count += len(entries) - len(retry)
+                if not retry:
+                    break
+                attempt += 1
+                if attempt > self.max_retries:
+                    # Give up on the records and keep them for the caller to inspect
+                    self.failed_count += len(retry)
+                    self.failed_records.extend(retry)
+                    break
+                # Wait with an exponential backoff and some jitter before sending the failed records again
+                time.sleep(self.backoff * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5))
+                entries = retry
+
+    # Flush the buffer in the background whenever the oldest records have waited for the linger time
+    # An error does not stop the thread, the records would otherwise only be sent once the buffer is full
+    def _linger_loop(self):
+        while not self.closed.wait(self.linger):
+            try:
+                pending = self.buffer or any(len(aggregator) for aggregator in list(self.aggregators.values()))
+                if pending and time.time() - self.last_flush >= self.linger:
+                    self.flush()
+            except Exception as e:
+                print('Could not flush the records: {}'.format(e))
+
+    # Stop the background thread and send the remaining records
+    def close(self):
+        self.closed.set()
+        self.flusher.join()
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Create a producer for asyncio code, the blocking 'put_records' calls run on a thread pool
+#
+# - 'put' waits while the maximum number of records is buffered, so a fast producer is slowed down
+#   instead of growing the memory, and returns a future resolving to the result of the record
+# - At most 'max_in_flight' 'put_records' calls run at the same time, which keeps several shards busy
+# - With more than one request in flight the records of a partition key may be written out of order
+class AsyncProducer:
+
+    def __init__(self, stream_name, client=None, max_in_flight=8, max_records=MAX_BATCH_RECORDS,
+                 max_bytes=MAX_BATCH_BYTES, max_buffered=10000, linger=0.05, max_retries=5, backoff=0.1,
+                 router=None, executor=None):
+        self.stream_name = stream_name
+        # Use the module's kinesis client if no client is passed in
+        self.client = client or kinesis
+        self.max_records = min(max_records, MAX_BATCH_RECORDS)
+        self.max_bytes = min(max_bytes, MAX_BATCH_BYTES)
+        self.linger = linger
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.router = router
+        self.max_in_flight = max_in_flight
+        self.max_buffered = max_buffered
+        # The thread pool running the blocking calls of the client
+        self.executor = executor or ThreadPoolExecutor(max_workers=max_in_flight)
+        self.own_executor = executor is None
+        # The records and their futures waiting to be sent
+        self.buffer = []
+        self.buffer_bytes = 0
+        # The asyncio objects are created on first use, inside the running event loop
+        self.in_flight = None
+        self.space = None
+        self.tasks = set()
+        self.linger_task = None
+        self.closed = False
+        # Counters for the records sent, failed and the number of 'put_records' calls
+        self.sent_count = 0
+        self.failed_count = 0
+        self.request_count = 0
+
+    # Create the semaphores and the linger task in the running event loop
+    def _start(self):
+        if self.in_flight is None:
+            self.in_flight = asyncio.Semaphore(self.max_in_flight)
+            self.space = asyncio.Semaphore(self.max_buffered)
+            self.linger_task = asyncio.ensure_future(self._linger_loop())
+
+    # Add a record, waiting while the buffers are full, returns a future of the record's result
+    async def put(self, data, partition_key, explicit_hash_key=None, ordered=False):
+        if self.closed:
+            raise RuntimeError('Producer is closed')
+        self._start()
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        # Reading the shard map blocks, so it runs on the thread pool
+        if self.router is not None and explicit_hash_key is None:
+            if self.router.stale():
+                await asyncio.get_running_loop().run_in_executor(self.executor, self.router.refresh)
+            _, explicit_hash_key = self.router.route(partition_key, ordered)
+        record = {'Data': data, 'PartitionKey': partition_key}
+        if explicit_hash_key is not None:
+            record['ExplicitHashKey'] = explicit_hash_key
+        size = len(data) + len(partition_key.encode('utf-8'))
+        if size > MAX_RECORD_BYTES:
+            raise ValueError('Record of {} bytes is above the 1 MB limit'.format(size))
+        # Backpressure, wait until there is room for another record
+        await self.space.acquire()
+        if self.buffer and (len(self.buffer) + 1 > self.max_records or self.buffer_bytes + size > self.max_bytes):
+            self._dispatch()
+        future = asyncio.get_running_loop().create_future()
+        self.buffer.append((record, future))
+        self.buffer_bytes += size
+        if len(self.buffer) >= self.max_records:
+            self._dispatch()
+        return future
+
+    # Start sending the buffered records as a batch in a new task
+    def _dispatch(self):
+        if not self.buffer:
+            return
+        batch = self.buffer
+        self.buffer = []
+        self.buffer_bytes = 0
+        task = asyncio.ensure_future(self._send(batch))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    # Send a batch with 'put_records' and retry only the entries that failed
+    async def _send(self, batch):
+        loop = asyncio.get_running_loop()
+        entries = batch
+        attempt = 0
+        try:
+            while entries:
+                # The error of the last call when the whole call failed, passed on to the records when giving up
+                error = None
+                self.request_count += 1
+                try:
+                    async with self.in_flight:
+                        response = await loop.run_in_executor(
+                            self.executor,
+                            partial(self.client.put_records, StreamName=self.stream_name,
+                                    Records=[record for record, _ in entries]))
+                except (ClientError, BotoCoreError) as e:
+                    print('Could not put {} records: {}'.format(len(entries), e))
+                    error = e
+                    retry = entries
+                else:
+                    retry = []
+                    for (record, future), result in zip(entries, response['Records']):
+                        if 'ErrorCode' in result:
+                            retry.append((record, future))
+                        else:
+                            self._resolve(future, result)
+                self.sent_count += len(entries) - len(retry)
+                if not retry:
+                    break
+                attempt += 1
+                if attempt > self.max_retries:
+                    self.failed_count += len(retry)
+                    for record, future in retry:
+                        self._resolve(future, exception=error or RuntimeError('Record failed after {} retries'.format(self.max_retries)))
+                    break
+                await asyncio.sleep(self.backoff * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5))
+                entries = retry
+        except Exception as e:
+            # Pass the error of the call on to every record still waiting for a result
+            self.failed_count += len(entries)
+            for record, future in entries:
+                self._resolve(future, exception=e)
+
+    # Set the result of a record's future and free its place in the buffer
+    def _resolve(self, future, result=None, exception=None):
+        if not future.done():
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+        self.space.release()
+
+    # Send the buffer once the linger time has passed
+    async def _linger_loop(self):
+        while not self.closed:
+            await asyncio.sleep(self.linger)
+            self._dispatch()
+
+    # Send all the buffered records and wait for every request in flight
+    async def flush(self):
+        if self.in_flight is None:
+            return
+        self._dispatch()
+        if self.tasks:
+            await asyncio.gather(*list(self.tasks))
+
+    # Flush the records and stop the producer
+    async def close(self):
+        if self.closed:
+            return
+        await self.flush()
+        self.closed = True
+        if self.linger_task is not None:
+            self.linger_task.cancel()
+        if self.own_executor:
+            self.executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
 
 # Create a function to put the records into the kinesis stream
-def put_to_stream(thing_id, property_value, property_timestamp):
+def put_to_stream(producer, thing_id, property_value, property_timestamp, codec='sensor'):
     # Define the data payload
     payload = {
-                'prop': str(property_value),
-                'timestamp': str(property_timestamp)
+                'prop': property_value,
+                'timestamp': property_timestamp
               }
 
-    print(payload)
-    # Put the record into the stream
-    put_response = kinesis_client.put_record(
-                        StreamName=stream_name,  # Stream name 
-                        Data=json.dumps(payload),   # Serialized payload
-                        PartitionKey=thing_id)      # Partition key to determine to be sent to which shard 
-
-
-while True:
-    # Create a random integer value
-    property_value = random.randint(40, 120)
-    # Get the calendar data
-    property_timestamp = calendar.timegm(datetime.utcnow().timetuple())
-    # Assign a partition key
-    thing_id = 'abc'
-    # Put the records into the stream
-    put_to_stream(thing_id, property_value, property_timestamp)
-    
+    # Add the record to the producer which sends it as part of a batch
+    producer.put(Codec.encode(payload, codec),   # Payload encoded with the codec, the consumer detects the codec from its header
+                 thing_id)                       # Partition key to determine to be sent to which shard
+
+
+if __name__ == '__main__':
+    # Create a kinesis stream with the stream name and the number of required shards
+    stream_create = kinesis.create_stream(StreamName=stream_name, ShardCount=1)
+    print(stream_create)
+
+    # Create the batching producer for the stream, aggregating the small payloads into larger kinesis records
+    # and spreading them over all the shards of the stream
+    producer = BatchProducer(stream_name, aggregate=True, router=ShardRouter(stream_name))
 
+    while True:
+        # Create a random integer value
+        property_value = random.randint(40, 120)
+        # Get the calendar data
+        property_timestamp = calendar.timegm(datetime.utcnow().timetuple())
+        # Assign a partition key
+        thing_id = 'abc'
+        # Put the records into the stream
+        put_to_stream(producer, thing_id, property_value, property_timestamp)
@@ -16,18 +16,29 @@ Following are the action on S3
 - Encrypting the contents in the bucket
 - Uploading files to S3
 - Uploading files to S3 using multipart feature
+- Uploading and downloading large files in parallel parts, tuning the part size and the number of threads
 - Enable versioning
 - Download files
 - Delete files
 - Delete bucket
+- Deleting any number of objects and versions with parallel requests of 1000 keys
 
 '''
 
 #Import necessary modules
 import boto3
 from boto3.s3.transfer import TransferConfig
+import os
 import json
+import math
+import time
 import uuid
+import random
+import threading
+from queue import Queue, Empty, Full
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError, BotoCoreError, HTTPClientError, IncompleteReadError
+from botocore.exceptions import ConnectionError as EndpointError
 
 # Create a S3 client
 s3_client = boto3.client('s3')
@@ -143,10 +154,239 @@ s3_client.upload_file('word.txt',          # The file path
                       Key='word.txt')      # The key or name of the file in the bucket
 
 
-# Create  a transfer configuration to upload large files as multipart
-transfer_config = TransferConfig(multipart_threshold=1024*10, # The minimum size of the file to be uploaded as multipart in MB
-                                 max_concurrency=5,           # The number of threads
-                                multipart_chunksize=1024* 5)  # The size of chunked file parts in MB
+# Limits of the multipart uploads set by s3
+MB = 1024 * 1024
+MIN_PART_SIZE = 5 * MB             # Every part but the last one has at least 5 MB
+MAX_PART_SIZE = 5 * 1024 * MB      # A part has at most 5 GB
+MAX_PARTS = 10000                  # An upload has at most 10000 parts
+MAX_SINGLE_UPLOAD = 5 * 1024 * MB  # Larger objects have to be uploaded in parts
+# The smallest file uploaded in parts, smaller files are faster with a single request
+MIN_MULTIPART_THRESHOLD = 16 * MB
+# The largest part picked from the measured bandwidth, larger parts only make retries more expensive
+MAX_TUNED_PART_SIZE = 64 * MB
+# Errors of a part which may pass on a retry, a missing object, a denied access or a changed object do not
+TRANSIENT_ERRORS = ('SlowDown', 'Throttling', 'ThrottlingException', 'RequestTimeout', 'RequestTimeTooSkewed',
+                    'InternalError', 'ServiceUnavailable')
+
+
+# Create a tuner of the number of parts transferred at the same time
+#
+# The throughput of all the parts together is measured over windows of finished parts. The number
+# of parallel parts moves by one after every window in the same direction as long as the throughput
+# does not drop by more than 5%, otherwise it turns around, so it settles close to the best value.
+class ConcurrencyTuner:
+
+    def __init__(self, initial, maximum, window=4):
+        self.limit = max(1, min(initial, maximum))
+        self.maximum = maximum
+        self.window = window
+        self.direction = 1
+        self.previous = None
+        self.active = 0
+        self.condition = threading.Condition()
+        # The bytes and the time of the current window, and of the whole transfer
+        self.window_bytes = 0
+        self.window_parts = 0
+        self.window_start = time.time()
+        self.started = self.window_start
+        self.total_bytes = 0
+        # The throughput of every part in bytes per second, and the throughput of every window with its limit
+        self.part_rates = []
+        self.history = []
+
+    # Wait until another part may be transferred
+    def acquire(self):
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+
+    # Record a finished part with its size and the seconds it took
+    def release(self, size, seconds):
+        with self.condition:
+            self.active -= 1
+            self.total_bytes += size
+            self.part_rates.append(size / max(seconds, 1e-9))
+            self.window_bytes += size
+            self.window_parts += 1
+            # A window holds at least as many parts as run at the same time
+            if self.window_parts >= max(self.window, self.limit):
+                self._tune()
+            self.condition.notify_all()
+
+    # Move the limit after a window, must be called holding the condition
+    def _tune(self):
+        now = time.time()
+        throughput = self.window_bytes / max(now - self.window_start, 1e-9)
+        self.history.append((self.limit, throughput))
+        if self.previous is not None and throughput < self.previous * 0.95:
+            self.direction = -self.direction
+        self.previous = throughput
+        self.limit = max(1, min(self.maximum, self.limit + self.direction))
+        self.window_bytes = 0
+        self.window_parts = 0
+        self.window_start = now
+
+    # The throughput of the whole transfer in bytes per second
+    def throughput(self):
+        return self.total_bytes / max(time.time() - self.started, 1e-9)
+
+
+# Create a transfer engine uploading and downloading large files in parts on a pool of threads
+#
+# - The part size is the smallest multiple of 1 MB above the 5 MB minimum which keeps the object under
+#   10000 parts, raised to about a quarter second of the bandwidth once it is known, up to 64 MB and
+#   as long as there are two parts for every thread
+# - Files above twice the part size, and at least 16 MB, are transferred in parts
+# - The number of parts transferred at the same time is tuned while the transfer runs and the tuned value
+#   and the measured bandwidth are kept as the start of the next transfer
+class AdaptiveTransfer:
+
+    def __init__(self, client=None, max_concurrency=32, bandwidth=None, retries=3):
+        self.client = client or s3_client
+        self.max_concurrency = max_concurrency
+        # The bandwidth in bytes per second, given or measured by the last transfer
+        self.bandwidth = bandwidth
+        self.concurrency = None
+        self.retries = retries
+        self.last_tuner = None
+
+    # Pick the multipart threshold, the part size and the starting concurrency for an object size
+    def plan(self, size):
+        part_size = max(MIN_PART_SIZE, math.ceil(size / MAX_PARTS / MB) * MB)
+        if self.bandwidth:
+            # Larger parts for a fast link, but still enough parts to keep all the threads busy
+            tuned = min(MAX_TUNED_PART_SIZE, self.bandwidth / 4, size / (2 * self.max_concurrency))
+            part_size = max(part_size, math.ceil(tuned / MB) * MB)
+        part_size = min(part_size, MAX_PART_SIZE)
+        threshold = min(max(MIN_MULTIPART_THRESHOLD, 2 * part_size), MAX_SINGLE_UPLOAD)
+        parts = max(1, math.ceil(size / part_size))
+        concurrency = min(self.concurrency or max(2, self.max_concurrency // 4), parts, self.max_concurrency)
+        return {'threshold': threshold, 'part_size': part_size, 'parts': parts, 'concurrency': concurrency}
+
+    # Get a boto3 transfer configuration following the plan, for 'upload_file' and 'download_file'
+    def transfer_config(self, size):
+        plan = self.plan(size)
+        return TransferConfig(multipart_threshold=plan['threshold'],  # The minimum size in bytes to transfer in parts
+                              multipart_chunksize=plan['part_size'],  # The size of the parts in bytes
+                              max_concurrency=plan['concurrency'])    # The number of threads
+
+    # Check whether an error is a throttled request, a server error or a dropped connection
+    def _transient(self, error):
+        if isinstance(error, ClientError):
+            return (error.response['Error']['Code'] in TRANSIENT_ERRORS or
+                    error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0) >= 500)
+        return isinstance(error, (EndpointError, HTTPClientError, IncompleteReadError))
+
+    # Call a function, trying again a few times when it fails with a transient error
+    def _retry(self, function, *args):
+        for attempt in range(self.retries):
+            try:
+                return function(*args)
+            except (ClientError, BotoCoreError) as e:
+                if attempt == self.retries - 1 or not self._transient(e):
+                    raise
+                time.sleep(0.2 * 2 ** attempt * random.uniform(0.5, 1.5))
+
+    # Transfer the parts on a pool of threads gated by the tuner, returns the results in the order of the parts
+    def _run_parts(self, plan, size, transfer_part):
+        tuner = ConcurrencyTuner(plan['concurrency'], self.max_concurrency)
+        # Set by the first part which fails for good, the parts not started yet are then skipped
+        stopped = threading.Event()
+
+        def run(part_number):
+            offset = (part_number - 1) * plan['part_size']
+            length = min(plan['part_size'], size - offset)
+            if stopped.is_set():
+                return None
+            tuner.acquire()
+            start = time.time()
+            try:
+                # Checked again as the part may have waited for its turn while another one failed
+                if stopped.is_set():
+                    return None
+                return self._retry(transfer_part, part_number, offset, length)
+            except Exception:
+                stopped.set()
+                raise
+            finally:
+                tuner.release(length, time.time() - start)
+
+        executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+        try:
+            futures = [executor.submit(run, part_number) for part_number in range(1, plan['parts'] + 1)]
+            results = [future.result() for future in futures]
+        finally:
+            # On an error the queued parts are cancelled, so the upload is aborted without waiting for them
+            executor.shutdown(wait=True, cancel_futures=True)
+        # Start the next transfer from what was measured by this one
+        self.bandwidth = tuner.throughput()
+        self.concurrency = tuner.limit
+        self.last_tuner = tuner
+        return results
+
+    # Upload a file, in parts if it is above the threshold
+    def upload(self, path, bucket, key, extra_args=None):
+        size = os.path.getsize(path)
+        plan = self.plan(size)
+        if size < plan['threshold']:
+            with open(path, 'rb') as f:
+                return self.client.put_object(Bucket=bucket, Key=key, Body=f, **(extra_args or {}))
+        upload_id = self.client.create_multipart_upload(Bucket=bucket, Key=key, **(extra_args or {}))['UploadId']
+
+        # Upload a part read from its offset in the file
+        def upload_part(part_number, offset, length):
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                body = f.read(length)
+            response = self.client.upload_part(Bucket=bucket, Key=key, UploadId=upload_id,
+                                               PartNumber=part_number, Body=body)
+            return {'PartNumber': part_number, 'ETag': response['ETag']}
+
+        try:
+            parts = self._run_parts(plan, size, upload_part)
+        except Exception:
+            # Do not leave the uploaded parts behind, they are billed until the upload is aborted
+            self.client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+            raise
+        return self.client.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id,
+                                                     MultipartUpload={'Parts': parts})
+
+    # Download an object into a file, in ranges of the part size if it is above the threshold
+    # Every range is read from the version seen by 'head_object', so an object overwritten during the download
+    # fails it with 'PreconditionFailed' instead of mixing the ranges of two objects into the file
+    def download(self, bucket, key, path):
+        head = self.client.head_object(Bucket=bucket, Key=key)
+        size = head['ContentLength']
+        pinned = {'VersionId': head['VersionId']} if head.get('VersionId') else {'IfMatch': head['ETag']}
+        plan = self.plan(size)
+        if size < plan['threshold']:
+            body = self.client.get_object(Bucket=bucket, Key=key, **pinned)['Body'].read()
+            with open(path, 'wb') as f:
+                f.write(body)
+            return size
+        # Create the file with its full size, so every range is written at its offset
+        with open(path, 'wb') as f:
+            f.truncate(size)
+
+        # Download a range of the object and write it at its offset in the file
+        def download_part(part_number, offset, length):
+            response = self.client.get_object(Bucket=bucket, Key=key,
+                                              Range='bytes={}-{}'.format(offset, offset + length - 1), **pinned)
+            body = response['Body'].read()
+            with open(path, 'r+b') as f:
+                f.seek(offset)
+                f.write(body)
+
+        self._run_parts(plan, size, download_part)
+        return size
+
+
+# The transfer engine shared by the uploads and downloads below
+transfer = AdaptiveTransfer()
+
+# Create a transfer configuration to upload large files as multipart, following the plan of the engine for the file size
+transfer_config = transfer.transfer_config(os.path.getsize('Networking.pdf'))
 
 
 # Upload a large file utilizing the multipart feature
@@ -156,6 +396,15 @@ s3_client.upload_file('Networking.pdf',                       # The file path
                                  'ContentType': 'text/pdf'},  # Specify the content of the file
                       Config=transfer_config)                 # Pass in the transfer configuration 
 
+# Upload the large file with the transfer engine, which tunes the number of parts sent at the same time
+transfer.upload('Networking.pdf', BUCKET_NAME, 'Networking_tuned.pdf', extra_args={'ContentType': 'text/pdf'})
+
+# Download it again in parallel ranges and print the measured throughput
+transfer.download(BUCKET_NAME, 'Networking_tuned.pdf', 'downloaded_networking.pdf')
+# The throughput is only measured for the files transferred in parts
+if transfer.bandwidth:
+    print('Downloaded at {:.1f} MB/s with {} parts at the same time'.format(transfer.bandwidth / MB, transfer.concurrency))
+
 
 # Enable versioning on the bucket 
 version_bucket = s3_client.put_bucket_versioning(Bucket=BUCKET_NAME, VersioningConfiguration={'Status': 'Enabled'})
@@ -211,16 +460,204 @@ s3_client.download_file(second_bucket,    # Bucket name
                         'second_word.txt')# Destination file path 
 
 
+# Limit of a single 'delete_objects' call set by s3
+MAX_DELETE_KEYS = 1000
+# Errors of a key which fail the same way on every retry
+PERMANENT_DELETE_ERRORS = ('AccessDenied',)
+
+
+# Create a deleter removing any number of objects or object versions from a bucket
+#
+# - The keys are streamed from the paginated listings, first the keys at the top of the prefix and the
+#   folders under it with a '/' delimiter, then the folders are listed in parallel by 'listers' threads
+# - The keys are packed into 'delete_objects' requests of 1000 keys sent on a pool of threads, only a
+#   few requests per thread wait at a time so the memory stays flat for any number of keys
+# - The keys s3 reports in 'Errors' are sent again with an exponential backoff, after 'max_retries'
+#   attempts or on a permanent error they are kept in 'errors'
+# - The progress is printed every 'report_interval' seconds
+class BulkDeleter:
+
+    def __init__(self, bucket_name, client=None, max_workers=16, listers=4, max_retries=5, report_interval=5):
+        self.bucket_name = bucket_name
+        self.client = client or s3_client
+        self.max_workers = max_workers
+        self.listers = listers
+        self.max_retries = max_retries
+        self.report_interval = report_interval
+        self.lock = threading.Lock()
+        # Counters of the deleter and the keys which could not be deleted
+        self.listed_count = 0
+        self.deleted_count = 0
+        self.errors = []
+        self.started = None
+
+    # Read the pages of a listing, yielding the keys and the folders of every page
+    def _pages(self, prefix, versions, delimiter=None):
+        kwargs = {'Bucket': self.bucket_name, 'Prefix': prefix}
+        if delimiter:
+            kwargs['Delimiter'] = delimiter
+        if versions:
+            paginator = self.client.get_paginator('list_object_versions')
+        else:
+            paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(**kwargs):
+            if versions:
+                # The delete markers are versions too and have to go for the bucket to be empty
+                keys = [{'Key': version['Key'], 'VersionId': version['VersionId']}
+                        for version in page.get('Versions', []) + page.get('DeleteMarkers', [])]
+            else:
+                keys = [{'Key': obj['Key']} for obj in page.get('Contents', [])]
+            yield keys, [common['Prefix'] for common in page.get('CommonPrefixes', [])]
+
+    # Stream the keys under a prefix, listing the folders under it in parallel
+    def _stream(self, prefix, versions):
+        folders = []
+        for keys, common_prefixes in self._pages(prefix, versions, delimiter='/'):
+            folders.extend(common_prefixes)
+            yield keys
+        if not folders:
+            return
+        # The listers put the pages of the folders into a queue, None marks a finished lister
+        pages = Queue(maxsize=self.listers * 4)
+        folder_queue = Queue()
+        for folder in folders:
+            folder_queue.put(folder)
+        # Set once the stream is closed, so the listers stop instead of waiting on a full queue nobody reads
+        stopped = threading.Event()
+
+        def put(item):
+            while not stopped.is_set():
+                try:
+                    pages.put(item, timeout=0.5)
+                    return
+                except Full:
+                    continue
+
+        def list_folders():
+            try:
+                while not stopped.is_set():
+                    try:
+                        folder = folder_queue.get_nowait()
+                    except Empty:
+                        break
+                    for keys, _ in self._pages(folder, versions):
+                        if stopped.is_set():
+                            return
+                        put(keys)
+            except Exception as e:
+                put(e)
+            put(None)
+
+        threads = [threading.Thread(target=list_folders, daemon=True) for _ in range(min(self.listers, len(folders)))]
+        for thread in threads:
+            thread.start()
+        finished = 0
+        try:
+            while finished < len(threads):
+                keys = pages.get()
+                if keys is None:
+                    finished += 1
+                elif isinstance(keys, Exception):
+                    raise keys
+                else:
+                    yield keys
+        finally:
+            stopped.set()
+
+    # Delete a request of up to 1000 keys, sending the failed keys again
+    # The keys of a request which still fails after the retries are returned with the errors instead of raising,
+    # so the other requests go on
+    def _delete_chunk(self, keys):
+        attempt = 0
+        while keys:
+            try:
+                response = self.client.delete_objects(Bucket=self.bucket_name, Delete={'Objects': keys, 'Quiet': True})
+                errors = response.get('Errors', [])
+            except (ClientError, BotoCoreError) as e:
+                # A throttled, failed or dropped request is sent again as a whole
+                code = e.response['Error']['Code'] if isinstance(e, ClientError) else type(e).__name__
+                errors = [dict(key, Code=code) for key in keys]
+            retry = []
+            for error in errors:
+                key = {'Key': error['Key']}
+                if error.get('VersionId'):
+                    key['VersionId'] = error['VersionId']
+                if error['Code'] in PERMANENT_DELETE_ERRORS or attempt >= self.max_retries:
+                    with self.lock:
+                        self.errors.append(error)
+                else:
+                    retry.append(key)
+            with self.lock:
+                self.deleted_count += len(keys) - len(errors)
+            if retry:
+                # Wait with an exponential backoff and some jitter before sending the failed keys again
+                time.sleep(0.1 * (2 ** attempt) * random.uniform(0.5, 1.5))
+            attempt += 1
+            keys = retry
+
+    # Print the progress and the throughput of the deleter
+    def report(self):
+        elapsed = time.time() - self.started
+        print('Deleted {} of {} listed keys in {:.1f}s, {:.0f} keys/s, {} errors'.format(
+            self.deleted_count, self.listed_count, elapsed, self.deleted_count / max(elapsed, 1e-9), len(self.errors)))
+
+    # Delete the keys of an iterable of pages, returns the keys which could not be deleted
+    def _run(self, pages):
+        self.started = time.time()
+        self.listed_count = 0
+        self.deleted_count = 0
+        self.errors = []
+        next_report = self.started + self.report_interval
+        # Only two requests per thread wait for a thread at a time
+        waiting = threading.BoundedSemaphore(self.max_workers * 2)
+        futures = []
+        chunk = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+
+            def submit(keys):
+                waiting.acquire()
+                future = executor.submit(self._delete_chunk, keys)
+                future.add_done_callback(lambda future: waiting.release())
+                futures.append(future)
+
+            for keys in pages:
+                self.listed_count += len(keys)
+                chunk.extend(keys)
+                while len(chunk) >= MAX_DELETE_KEYS:
+                    submit(chunk[:MAX_DELETE_KEYS])
+                    chunk = chunk[MAX_DELETE_KEYS:]
+                # Keep only the requests which are not done, so the list does not grow with the keys
+                futures = [future for future in futures if not future.done() or future.exception()]
+                if time.time() >= next_report:
+                    self.report()
+                    next_report += self.report_interval
+            if chunk:
+                submit(chunk)
+        for future in futures:
+            future.result()
+        self.report()
+        return self.errors
+
+    # Delete the given keys, as names or as dictionaries with the 'Key' and the 'VersionId'
+    def delete_keys(self, keys):
+        keys = [{'Key': key} if isinstance(key, str) else key for key in keys]
+        return self._run(keys[i:i + MAX_DELETE_KEYS] for i in range(0, len(keys), MAX_DELETE_KEYS))
+
+    # Delete all the objects under a prefix, or all their versions and delete markers with 'versions'
+    def delete_prefix(self, prefix='', versions=False):
+        pages = self._stream(prefix, versions)
+        try:
+            return self._run(pages)
+        finally:
+            # Stop the listers when the deletion fails
+            pages.close()
+
+
 # Create a function to delete multiple files at a time from a bucket
+# Any number of files are deleted in requests of 1000 keys, returns the keys which could not be deleted
 def delete_files(bucket_name, *args):
-    key_list = []
-    # Specify the files to be deleted in *args and insert all into a list
-    for arg in args:
-        key_list.append({'Key': arg})
     # Delete the files using the bucket name the list of the files to be deleted
-    delete_response = s3_client.delete_objects(Bucket=bucket_name, 
-                                               Delete={'Objects': key_list})
-    return delete_response
+    return BulkDeleter(bucket_name).delete_keys(list(args))
 
 
 # Delete two files from the first bucket
@@ -229,14 +666,12 @@ delete_files(BUCKET_NAME, 'Networking_book.pdf', 'word.txt')
 
 # Function to delete a bucket from s3
 def delete_bucket(bucket_name):
-    # Create an s3 resource
-    s3_resource = boto3.resource('s3')
-    # Get the bucket instance 
-    bucket = s3_resource.Bucket(bucket_name)
     # Delete all the version of the objects in the bucket inorder to successfully delete a bucket
-    bucket.object_versions.delete()
+    errors = BulkDeleter(bucket_name).delete_prefix(versions=True)
+    if errors:
+        raise RuntimeError('Could not delete {} versions of bucket {}'.format(len(errors), bucket_name))
     # Finally delete the bucket
-    bucket.delete()
+    s3_client.delete_bucket(Bucket=bucket_name)
     
 # Delete the first bucket
 delete_bucket(BUCKET_NAME)
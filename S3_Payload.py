@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''
+
+Storing large SQS and SNS message payloads in S3
+
+- Uploading a message body above a size threshold to S3 and sending a small pointer instead
+- The pointer uses the same format as the AWS extended client libraries for SQS and SNS
+- Resolving the pointers back to the payloads, one at a time or in parallel
+- Deleting the S3 objects of the messages, up to 1000 keys per request
+
+'''
+
+# Import necessary packages
+import boto3
+import json
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# Create a S3 client
+s3_client = boto3.client('s3')
+
+# The class name written into the pointer by the extended client libraries
+POINTER_CLASS = 'software.amazon.payloadoffloading.PayloadS3Pointer'
+# Message attribute holding the size of the payload stored in S3
+SIZE_ATTRIBUTE = 'ExtendedPayloadSize'
+# Message attribute marking a payload shared by several receivers, like the subscribers of a SNS topic,
+# so a single receiver deleting its message does not delete the payload of the others
+SHARED_ATTRIBUTE = 'ExtendedPayloadShared'
+# Bodies above this size in bytes, together with their message attributes, are stored in S3
+DEFAULT_THRESHOLD = 256 * 1024
+
+
+# Function to compute the size of a message body and its message attributes
+# The limits count UTF-8 bytes, so the text is encoded before counting
+def payload_size(body, attributes=None):
+    size = len(body.encode('utf-8'))
+    for name, attr in (attributes or {}).items():
+        value = attr.get('StringValue') or attr.get('BinaryValue') or b''
+        if isinstance(value, str):
+            value = value.encode('utf-8')
+        size += len(name.encode('utf-8')) + len(attr['DataType'].encode('utf-8')) + len(value)
+    return size
+
+
+# Function to store a body in S3 when it is above the threshold, returns the body and the message attributes to send
+def offload(body, bucket, threshold=DEFAULT_THRESHOLD, attributes=None, prefix='', shared=False):
+    attributes = dict(attributes or {})
+    size = payload_size(body, attributes)
+    if size <= threshold:
+        return body, attributes
+    key = prefix + str(uuid.uuid4())
+    # Upload the body as the object in the bucket
+    s3_client.put_object(Bucket=bucket, Key=key, Body=body.encode('utf-8'))
+    attributes[SIZE_ATTRIBUTE] = {'DataType': 'Number', 'StringValue': str(len(body.encode('utf-8')))}
+    if shared:
+        attributes[SHARED_ATTRIBUTE] = {'DataType': 'String', 'StringValue': 'true'}
+    pointer = json.dumps([POINTER_CLASS, {'s3BucketName': bucket, 's3Key': key}])
+    return pointer, attributes
+
+
+# Function to read the bucket and key of a pointer, returns None for a body which is not a pointer
+def parse_pointer(body):
+    if not body.startswith('["' + POINTER_CLASS):
+        return None
+    _, location = json.loads(body)
+    return location['s3BucketName'], location['s3Key']
+
+
+# Function to check whether a body is a pointer to a payload in S3
+def is_pointer(body):
+    return parse_pointer(body) is not None
+
+
+# Function to get the payload of a body, downloading it from S3 if the body is a pointer
+def resolve(body):
+    location = parse_pointer(body)
+    if location is None:
+        return body
+    bucket, key = location
+    return s3_client.get_object(Bucket=bucket, Key=key)['Body'].read().decode('utf-8')
+
+
+# Function to resolve many bodies, downloading the payloads in parallel
+def resolve_all(bodies, max_workers=8):
+    if not any(is_pointer(body) for body in bodies):
+        return list(bodies)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(resolve, bodies))
+
+
+# Function to delete the payloads of pointer bodies, the objects are deleted with up to 1000 keys per request
+def delete_payloads(bodies):
+    keys_by_bucket = {}
+    for body in bodies:
+        location = parse_pointer(body)
+        if location:
+            keys_by_bucket.setdefault(location[0], []).append({'Key': location[1]})
+    errors = []
+    for bucket, keys in keys_by_bucket.items():
+        for i in range(0, len(keys), 1000):
+            response = s3_client.delete_objects(Bucket=bucket, Delete={'Objects': keys[i:i + 1000], 'Quiet': True})
+            errors.extend(response.get('Errors', []))
+    return errors
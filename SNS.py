@@ -13,7 +13,13 @@ Following are the actions on SNS
 - Getting and updating the topic attributes
 - Subscribe using email and SQS
 - Getting all the topics registered on SNS
+- Resolving the topic arns by name, cached on disk between the processes
+- Indexing the subscriptions of a topic by endpoint and protocol
 - Publishing messages from SNS to the subscribers subscribed to the topic
+- Publishing any number of messages as batches of up to 10 messages in parallel
+- Encoding the published messages with a compact codec
+- Skipping or tagging the messages which match the filter policy of no subscription
+- Storing large published messages in S3 and publishing a pointer instead
 - Opt out from the topics
 - Deleting the topics
 
@@ -22,14 +28,134 @@ Following are the actions on SNS
 
 # Import necessary packages
 import boto3
+import os
 import json
+import time
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+import Codec
+import S3_Payload
+import SNS_Filter
+import Batching
 
 
 # Create a sns cliet with the region name set
 sns = boto3.client('sns', region_name='us-east-2')
 
+
+
+# Create a registry of the topic arns by topic name
+#
+# A topic name is resolved the first time it is used, from the file cache or else by reading the pages of
+# 'list_topics' until the topic is found, remembering all the topics seen on the way. The arns are written
+# to the cache file so a new process does not list the topics again until the entries are older than the ttl.
+# The same name is a different topic in another region or account, so the entries are keyed by
+# 'region:account:name', the end of the arn, and the account of the credentials is read once with sts.
+class TopicRegistry:
+
+    def __init__(self, path=os.path.expanduser('~/.sns_topic_arns.json'), ttl=24 * 3600):
+        self.path = path
+        self.ttl = ttl
+        # The arn of each topic key with the time it was resolved
+        self.arns = None
+        # The 'region:account:' of the sns client, read on first use
+        self.prefix = None
+        self.lock = threading.Lock()
+
+    # Get the key of a topic name in the region and account of the sns client, or the key of a topic arn
+    def _key(self, topic):
+        if topic.startswith('arn:'):
+            return ':'.join(topic.split(':')[3:])
+        if self.prefix is None:
+            account = boto3.client('sts', region_name=sns.meta.region_name).get_caller_identity()['Account']
+            self.prefix = '{}:{}:'.format(sns.meta.region_name, account)
+        return self.prefix + topic
+
+    # Read the cache file, a missing or broken file is an empty cache
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return {name: tuple(entry) for name, entry in json.load(f).items()}
+        except (OSError, ValueError):
+            return {}
+
+    # Read the cache file once
+    def _load(self):
+        if self.arns is None:
+            self.arns = self._read()
+
+    # Write the changed entries, None for a removed one, into the cache file as it is now, so the arns
+    # other processes cached since it was loaded are kept. The file is replaced at once so other
+    # processes never read half a file
+    def _save(self, changes):
+        arns = self._read()
+        for key, entry in changes.items():
+            if entry is None:
+                arns.pop(key, None)
+            else:
+                arns[key] = entry
+        self.arns = arns
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.arns, f)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            # The cache only saves calls, the registry works without it
+            pass
+
+    # Store the arns of topics, for example the one returned when a topic is created
+    def remember(self, *topic_arns):
+        with self.lock:
+            self._load()
+            changes = {self._key(arn): (arn, time.time()) for arn in topic_arns}
+            self.arns.update(changes)
+            self._save(changes)
+
+    # Get the arn of a topic, listing the topics only when it is not cached
+    def arn(self, topic_name):
+        key = self._key(topic_name)
+        with self.lock:
+            self._load()
+            entry = self.arns.get(key)
+        if entry and time.time() - entry[1] < self.ttl:
+            return entry[0]
+        paginator = sns.get_paginator('list_topics')
+        for page in paginator.paginate():
+            arns = [topic['TopicArn'] for topic in page['Topics']]
+            self.remember(*arns)
+            for arn in arns:
+                if arn.split(':')[-1] == topic_name:
+                    return arn
+        raise KeyError('Topic {} does not exist'.format(topic_name))
+
+    # Drop the arn of a topic given by name or arn, for example after deleting it
+    def forget(self, topic_name):
+        key = self._key(topic_name)
+        with self.lock:
+            self._load()
+            if self.arns.pop(key, None) is not None:
+                self._save({key: None})
+
+
+# The registry shared by all the functions below
+topic_registry = TopicRegistry()
+
+
+# Context manager dropping the arn of a topic, given by name or arn, when a call finds out the topic does not exist
+@contextmanager
+def topic_errors(topic_name):
+    try:
+        yield
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'NotFound':
+            topic_registry.forget(topic_name)
+        raise
+
+
 TOPIC_NAME = 'First_Topic_SNS'
-topic_arn = {}
 
 # Create a sns topic with optinally attributes
 def create_topic(topic_name, attr=None):
@@ -40,8 +166,8 @@ def create_topic(topic_name, attr=None):
     # If the attributes parameter is given create the topic wiht the given attribues
     else:
         response = sns.create_topic(Name=topic_name, Attributes=attr)
-    # Store the topic's arn in a dictionary with the topic name as the key
-    topic_arn[topic_name] = response['TopicArn']
+    # Store the topic's arn in the registry with the topic name as the key
+    topic_registry.remember(response['TopicArn'])
     return response
 
 
@@ -49,7 +175,7 @@ topic_response = create_topic(TOPIC_NAME)
 
 print(topic_response)
 
-print(topic_arn) 
+print(topic_registry.arn(TOPIC_NAME)) 
 
 SECOND_TOPIC = 'Second-Topic-SNS'
 
@@ -63,9 +189,10 @@ print(topics_list)
 # Get the attributes of the topic
 def get_topic_attr(topic_name):
     # Get the topic arn from the dictionary
-    topic_name_arn = topic_arn[topic_name]
+    topic_name_arn = topic_registry.arn(topic_name)
     # Return the attributes of the topic
-    return sns.get_topic_attributes(TopicArn=topic_name_arn)
+    with topic_errors(topic_name):
+        return sns.get_topic_attributes(TopicArn=topic_name_arn)
 
 
 print(get_topic_attr(SECOND_TOPIC))
@@ -73,9 +200,10 @@ print(get_topic_attr(SECOND_TOPIC))
 # Update a single attribute of a topic
 def update_topic_attr(topic_name, attr_name, attr_value):
     # Get the topic arn 
-    topic_name_arn = topic_arn[topic_name]
+    topic_name_arn = topic_registry.arn(topic_name)
     # Update the attribute of the topic using the given attribute name and value
-    sns.set_topic_attributes(TopicArn=topic_name_arn, AttributeName=attr_name, AttributeValue=attr_value)
+    with topic_errors(topic_name):
+        sns.set_topic_attributes(TopicArn=topic_name_arn, AttributeName=attr_name, AttributeValue=attr_value)
     
     
 # Update the 'DisplayName' attribute of the topic to the value 'First'
@@ -83,14 +211,145 @@ update_topic_attr(TOPIC_NAME, 'DisplayName', 'First')
 
 
 
+# Create an index of the subscriptions of the topics by their endpoint and protocol
+#
+# The subscriptions of a topic are read once with all the pages of 'list_subscriptions_by_topic',
+# after that the subscribe and unsubscribe calls of this module update the index directly and the
+# full listing is only read again when it is older than the ttl in seconds. The filter policies of
+# the subscriptions are compiled into a 'SNS_Filter.FilterPolicyIndex' which is kept until they change.
+class SubscriptionIndex:
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        # The subscriptions of each topic arn by (endpoint, protocol), with the time they were listed
+        self.subscriptions = {}
+        self.protocols = {}
+        self.loaded = {}
+        # The compiled filter policies of each topic arn
+        self.filters = {}
+        self.lock = threading.Lock()
+
+    # Read all the subscriptions of a topic and replace its index
+    # The attributes already read are kept for the subscriptions still there, so only the new ones are read again,
+    # and the compiled filters are kept while the subscriptions are the same
+    def refresh(self, topic_name_arn):
+        subscriptions = {}
+        protocols = {}
+        paginator = sns.get_paginator('list_subscriptions_by_topic')
+        for page in paginator.paginate(TopicArn=topic_name_arn):
+            for sub in page['Subscriptions']:
+                subscriptions[(sub['Endpoint'], sub['Protocol'])] = sub
+                protocols.setdefault(sub['Protocol'], {})[sub['Endpoint']] = sub
+        with self.lock:
+            previous = self.subscriptions.get(topic_name_arn, {})
+            attributes = {sub['SubscriptionArn']: sub['Attributes'] for sub in previous.values() if 'Attributes' in sub}
+            for sub in subscriptions.values():
+                if sub['SubscriptionArn'] in attributes:
+                    sub['Attributes'] = attributes[sub['SubscriptionArn']]
+            if set(sub['SubscriptionArn'] for sub in previous.values()) != \
+                    set(sub['SubscriptionArn'] for sub in subscriptions.values()):
+                self.filters.pop(topic_name_arn, None)
+            self.subscriptions[topic_name_arn] = subscriptions
+            self.protocols[topic_name_arn] = protocols
+            self.loaded[topic_name_arn] = time.time()
+
+    # Read the subscriptions of a topic when they are not indexed yet or too old
+    def _check(self, topic_name_arn):
+        if time.time() - self.loaded.get(topic_name_arn, 0) > self.ttl:
+            self.refresh(topic_name_arn)
+
+    # Add a subscription made by this process to the index
+    def add(self, topic_name_arn, sub):
+        with self.lock:
+            if topic_name_arn not in self.subscriptions:
+                return
+            self.subscriptions[topic_name_arn][(sub['Endpoint'], sub['Protocol'])] = sub
+            self.protocols[topic_name_arn].setdefault(sub['Protocol'], {})[sub['Endpoint']] = sub
+            self.filters.pop(topic_name_arn, None)
+
+    # Remove a subscription from the index
+    def remove(self, topic_name_arn, sub):
+        with self.lock:
+            self.subscriptions.get(topic_name_arn, {}).pop((sub['Endpoint'], sub['Protocol']), None)
+            self.protocols.get(topic_name_arn, {}).get(sub['Protocol'], {}).pop(sub['Endpoint'], None)
+            self.filters.pop(topic_name_arn, None)
+
+    # Get the subscriptions of a topic, optionally only the ones of a protocol
+    def all(self, topic_name_arn, protocol=None):
+        self._check(topic_name_arn)
+        with self.lock:
+            if protocol:
+                return list(self.protocols[topic_name_arn].get(protocol, {}).values())
+            return list(self.subscriptions[topic_name_arn].values())
+
+    # Get the subscriptions of an endpoint, with any protocol or only the given one
+    def find(self, topic_name_arn, endpoint, protocol=None):
+        self._check(topic_name_arn)
+        with self.lock:
+            if protocol:
+                sub = self.subscriptions[topic_name_arn].get((endpoint, protocol))
+                return [sub] if sub else []
+            return [subs[endpoint] for subs in self.protocols[topic_name_arn].values() if endpoint in subs]
+
+    # Forget the subscriptions of a topic, for example after deleting it
+    def invalidate(self, topic_name_arn):
+        with self.lock:
+            self.subscriptions.pop(topic_name_arn, None)
+            self.protocols.pop(topic_name_arn, None)
+            self.loaded.pop(topic_name_arn, None)
+            self.filters.pop(topic_name_arn, None)
+
+    # Read the attributes of the subscriptions which do not have them yet, in parallel
+    # A subscription waiting for its confirmation has no arn to read the attributes with
+    def fetch_attributes(self, subs, max_workers=8):
+        missing = [sub for sub in subs if 'Attributes' not in sub and sub['SubscriptionArn'].startswith('arn:')]
+
+        def fetch(sub):
+            sub['Attributes'] = sns.get_subscription_attributes(SubscriptionArn=sub['SubscriptionArn'])['Attributes']
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(fetch, missing))
+        return subs
+
+    # Get the compiled filter policies of the subscriptions of a topic
+    def filter_index(self, topic_name_arn):
+        self._check(topic_name_arn)
+        index = self.filters.get(topic_name_arn)
+        if index is None:
+            index = SNS_Filter.FilterPolicyIndex([])
+            for sub in self.fetch_attributes(self.all(topic_name_arn)):
+                attributes = sub.get('Attributes', {})
+                index.add(sub['SubscriptionArn'], attributes.get('FilterPolicy'),
+                          attributes.get('FilterPolicyScope', 'MessageAttributes'))
+            with self.lock:
+                self.filters[topic_name_arn] = index
+        return index
+
+
+# Index shared by the functions below
+subscription_index = SubscriptionIndex()
+
+
+# Function to subscribe an endpoint to a topic and add the subscription to the index
+def subscribe(topic_name_arn, protocol, endpoint, attributes=None):
+    with topic_errors(topic_name_arn):
+        response = sns.subscribe(TopicArn=topic_name_arn, Protocol=protocol, Endpoint=endpoint,
+                                 Attributes=attributes or {}, ReturnSubscriptionArn=True)
+    subscription_index.add(topic_name_arn, {'SubscriptionArn': response['SubscriptionArn'],
+                                            'Protocol': protocol,
+                                            'Endpoint': endpoint,
+                                            'TopicArn': topic_name_arn})
+    return response
+
+
 # Create a function to subscribe using email
 def email_subscribe(topic_name, email_id):
     # Get the topic arn
-    topic_name_arn = topic_arn[topic_name]
+    topic_name_arn = topic_registry.arn(topic_name)
     # Subscribe to the topics using the following parameters
-    response = sns.subscribe(TopicArn=topic_name_arn, # Topic's arn
-                             Protocol='email',        # Protocol, here it is email
-                             Endpoint=email_id)       # The subscriber's email id
+    response = subscribe(topic_name_arn, # Topic's arn
+                         'email',        # Protocol, here it is email
+                         email_id)       # The subscriber's email id
     return response
 
 # Subscribe to the given topic with the given email
@@ -102,11 +361,11 @@ print(sub_response)
 # Subscribe to the sqs queue
 def sqs_subscription(topic_name, sqs_arn):
     # Get the topic arn
-    topic_name_arn = topic_arn[topic_name]
-    response = sns.subscribe(TopicArn=topic_name_arn, # Topic arn
-                             Protocol='sqs',          # The protocol, here it is sqq
-                             Endpoint=sqs_arn,        # The arn of the sqs queue
-                             Attributes= {'RawMessageDelivery': 'true'}) # Set the attribute 'RawMessageDelivery' to receive the message raw
+    topic_name_arn = topic_registry.arn(topic_name)
+    response = subscribe(topic_name_arn, # Topic arn
+                         'sqs',          # The protocol, here it is sqq
+                         sqs_arn,        # The arn of the sqs queue
+                         {'RawMessageDelivery': 'true'}) # Set the attribute 'RawMessageDelivery' to receive the message raw
                                         
     return response
     
@@ -119,27 +378,16 @@ print(sqs_response)
 
 
 # Get the subscribers of a topic with an option to filter using the protocol
-def get_subscriptions_topic(topic_name, filter_by=None):
+# The subscriptions come from the index, which holds all the pages of the listing
+# With 'with_attributes' the attributes of each subscription, like its 'FilterPolicy', are read into 'Attributes'
+def get_subscriptions_topic(topic_name, filter_by=None, with_attributes=False):
     # Get the topic arn
-    topic_name_arn = topic_arn[topic_name]
-    # Make an empty list to hold the subscribers
-    sub_list = []
-    # If fitlering by protocol is enabled
-    if filter_by:
-        # List all the subscriptions 
-        response = sns.list_subscriptions_by_topic(TopicArn=topic_name_arn)['Subscriptions']
-        # Loop over all the subscriptions
-        for res in response:
-            # Select only subscriptions that match the specified protocol
-            if filter_by == res['Protocol']:
-                sub_list.append(res)
-    # If filtering is not enabled
-    else:
-        # Receive all the subscriptions
-        response = sns.list_subscriptions_by_topic(TopicArn=topic_name_arn)['Subscriptions']
-        # Loop over all the subscriptions and append it to the list
-        for res in response:
-            sub_list.append(res)
+    topic_name_arn = topic_registry.arn(topic_name)
+    # Get the subscriptions of the protocol, or all of them if filtering is not enabled
+    with topic_errors(topic_name):
+        sub_list = subscription_index.all(topic_name_arn, protocol=filter_by)
+    if with_attributes:
+        subscription_index.fetch_attributes(sub_list)
     return sub_list
 
 
@@ -156,32 +404,179 @@ filtered_sub_topic = get_subscriptions_topic(SECOND_TOPIC, 'sqs')
 print(filtered_sub_topic)
 
 
-# Publish messages to a topic
-def publish_msg(topic_name, msg):
+# Message attribute added to a message which matches the filter policy of no subscription
+UNMATCHED_ATTRIBUTE = 'NoSubscriberMatch'
+
+
+# Publish messages to a topic, optionally encoding the message with a codec
+# With a payload bucket a message above 256 KB is stored in the bucket and a pointer to it is published instead,
+# the payload is shared by all the subscribers so it is not deleted when one of them deletes its message
+#
+# The message attributes are checked against the filter policies of the subscriptions with 'prefilter':
+# 'skip' does not publish a message no subscriber would receive and returns None, 'tag' publishes it
+# with the 'NoSubscriberMatch' attribute, for example for a catch all subscription
+def publish_msg(topic_name, msg, codec=None, payload_bucket=None, attributes=None, prefilter=None):
     # Get the topic arn
-    topic_name_arn = topic_arn[topic_name]
+    topic_name_arn = topic_registry.arn(topic_name)
+    attributes = dict(attributes or {})
+    if prefilter:
+        with topic_errors(topic_name):
+            index = subscription_index.filter_index(topic_name_arn)
+    if prefilter and not index.any_match(attributes):
+        if prefilter == 'skip':
+            return None
+        attributes[UNMATCHED_ATTRIBUTE] = {'DataType': 'String', 'StringValue': 'true'}
+    # Encode the message as text with the codec, the subscribers decode it with 'Codec.decode_text'
+    if codec:
+        msg = Codec.encode_text(msg, codec)
+    if payload_bucket:
+        msg, attributes = S3_Payload.offload(msg, payload_bucket, attributes=attributes, shared=True)
     # Publish the message using
-    return sns.publish(TopicArn=topic_name_arn, # Topic arn
-                       Message=msg)             # The message
+    with topic_errors(topic_name):
+        return sns.publish(TopicArn=topic_name_arn,      # Topic arn
+                           Message=msg,                  # The message
+                           MessageAttributes=attributes) # Attributes, holding the payload size of a pointer
 
 # Publish message to the given topic
 publish_msg(SECOND_TOPIC, msg='Message to all the subscribers')
 
-
-# Unsubscribe from the topic for a subsciber
-def opt_out(topic_name, subscriber):
+# Publish a reading encoded with the json codec
+publish_msg(SECOND_TOPIC, msg={'prop': 87, 'timestamp': 1577836800}, codec='json')
+
+# Publish a message above the 256 KB limit, stored in a bucket
+publish_msg(SECOND_TOPIC, msg='x' * 300 * 1024, payload_bucket='sns-large-payloads')
+
+# Publish an event only if the filter policy of a subscription matches it
+publish_msg(SECOND_TOPIC, msg='Order shipped', prefilter='skip',
+            attributes={'event': {'DataType': 'String', 'StringValue': 'order_shipped'}})
+
+
+# Limits of a single 'publish_batch' call set by sns
+MAX_BATCH_ENTRIES = 10             # At most 10 messages in a batch
+MAX_BATCH_BYTES = 256 * 1024       # At most 256 KB for all the messages of a batch together
+
+
+# Function to split the entries into batches in their order, each within the limits of a 'publish_batch' call
+def split_batches(entries):
+    batches = []
+    batch = []
+    batch_bytes = 0
+    for entry in entries:
+        size = S3_Payload.payload_size(entry['Message'], entry.get('MessageAttributes'))
+        if batch and (len(batch) == MAX_BATCH_ENTRIES or batch_bytes + size > MAX_BATCH_BYTES):
+            batches.append(batch)
+            batch = []
+            batch_bytes = 0
+        batch.append(entry)
+        batch_bytes += size
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+# Function to publish a batch of entries, retrying only the entries which failed on the side of sns
+def publish_entries(topic_name_arn, entries, max_retries=5, backoff=0.1):
+    return Batching.send_batch(lambda pending: sns.publish_batch(TopicArn=topic_name_arn, PublishBatchRequestEntries=pending),
+                               entries, max_retries, backoff)
+
+
+# Function to publish any number of messages to a topic as batches of 10, the batches are published in parallel
+# Returns a result for each message in the order of the list, the 'MessageId' on success or the 'Code' of the error,
+# and prints the number of messages published per second
+# The messages of a fifo topic go into the group 'msg_group_id' and are published one batch after the other,
+# with 'content_dedup' their deduplication ids are the hashes of the bodies
+def publish_msg_batch(topic_name, msg_list, codec=None, max_workers=8, max_retries=5, payload_bucket=None,
+                      msg_group_id=None, content_dedup=False):
+    start = time.time()
+    # Get the topic arn
+    topic_name_arn = topic_registry.arn(topic_name)
+    fifo = topic_name_arn.endswith('.fifo')
+    # Encode the messages as text with the codec
+    if codec:
+        msg_list = [Codec.encode_text(msg, codec) for msg in msg_list]
+    offloaded = [(msg, {}) for msg in msg_list]
+    if payload_bucket:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            offloaded = list(executor.map(lambda msg: S3_Payload.offload(msg, payload_bucket, shared=True), msg_list))
+    # Create the entry for each message with its position in the list as the id
+    entries = []
+    for i, (msg, attributes) in enumerate(offloaded):
+        entry = {'Id': str(i), 'Message': msg}
+        if attributes:
+            entry['MessageAttributes'] = attributes
+        if fifo:
+            entry['MessageGroupId'] = msg_group_id
+            entry['MessageDeduplicationId'] = Batching.dedup_id(msg_list[i], content_dedup)
+        entries.append(entry)
+    results = [None] * len(entries)
+    # A message above the limit can never be published
+    sendable = []
+    for entry in entries:
+        if S3_Payload.payload_size(entry['Message'], entry.get('MessageAttributes')) > MAX_BATCH_BYTES:
+            results[int(entry['Id'])] = {'Id': entry['Id'], 'Code': 'MessageTooLong', 'SenderFault': True}
+        else:
+            sendable.append(entry)
+    batches = split_batches(sendable)
+    if fifo:
+        # The batches of a fifo topic go one after the other, after a failure the rest is not published
+        # as it would overtake the failed messages of the group
+        batch_results_list = []
+        for n, batch in enumerate(batches):
+            batch_results_list.append(publish_entries(topic_name_arn, batch, max_retries))
+            if any('MessageId' not in result for result in batch_results_list[-1].values()):
+                batch_results_list.extend({entry['Id']: Batching.unsent(entry['Id']) for entry in later}
+                                          for later in batches[n + 1:])
+                break
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            batch_results_list = list(executor.map(lambda batch: publish_entries(topic_name_arn, batch, max_retries), batches))
+    for batch_results in batch_results_list:
+        for entry_id, result in batch_results.items():
+            results[int(entry_id)] = result
+    # The failed calls are in the results instead of raising, a deleted topic still drops its cached arn
+    if any(result.get('Code') == 'NotFound' for result in results):
+        topic_registry.forget(topic_name)
+    elapsed = time.time() - start
+    published = sum(1 for result in results if 'MessageId' in result)
+    print('Published {} of {} messages in {:.1f}s, {:.0f} messages/s'.format(
+        published, len(results), elapsed, published / max(elapsed, 1e-9)))
+    return results
+
+
+# Publish a thousand messages to the topic as batches of 10
+bulk_results = publish_msg_batch(SECOND_TOPIC, ['Bulk message {}'.format(i) for i in range(1000)])
+
+
+# Unsubscribe a subscription and remove it from the index
+# A subscription still waiting for its confirmation has no arn yet and can not be unsubscribed
+def unsubscribe(topic_name_arn, sub):
+    if sub['SubscriptionArn'] in ('PendingConfirmation', 'pending confirmation'):
+        return False
+    sns.unsubscribe(SubscriptionArn=sub['SubscriptionArn'])
+    subscription_index.remove(topic_name_arn, sub)
+    return True
+
+
+# Unsubscribe from the topic for a subsciber, with any protocol or only the given one
+def opt_out(topic_name, subscriber, protocol=None):
     # Get the topic name
-    topic_name_arn = topic_arn[topic_name]
-    # Get all the subcribers of the topic
-    subscriptions = sns.list_subscriptions_by_topic(TopicArn=topic_name_arn)['Subscriptions']
-    # Loop over all the subscriptions
-    for sub in subscriptions:
-        # If the subscriber has really subsribed to the given topic
-        if subscriber == sub['Endpoint']:
-            # Get the subscription arn
-            sub_arn = sub['SubscriptionArn']
-            # Unubscribe from the topic using the subsriber's arn
-            sns.unsubscribe(SubscriptionArn = sub_arn)
+    topic_name_arn = topic_registry.arn(topic_name)
+    # Look up the subscriptions of the subscriber in the index and unsubscribe them
+    with topic_errors(topic_name):
+        subs = subscription_index.find(topic_name_arn, subscriber, protocol)
+    return [sub for sub in subs if unsubscribe(topic_name_arn, sub)]
+
+
+# Unsubscribe many subscribers from the topic, the 'unsubscribe' calls are made in parallel
+def bulk_opt_out(topic_name, subscribers, protocol=None, max_workers=8):
+    topic_name_arn = topic_registry.arn(topic_name)
+    subs = []
+    with topic_errors(topic_name):
+        for subscriber in subscribers:
+            subs.extend(subscription_index.find(topic_name_arn, subscriber, protocol))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        unsubscribed = list(executor.map(lambda sub: unsubscribe(topic_name_arn, sub), subs))
+    return [sub for sub, done in zip(subs, unsubscribed) if done]
             
 
 # Let the sqs queue opt out from its subscribed topic
@@ -190,13 +585,18 @@ opt_out(SECOND_TOPIC, 'arn:aws:sqs:us-east-2:458375213711:First-Queue')
 # Let the email opt out from its subscribed topic
 opt_out(SECOND_TOPIC, 'ashiqgiga07@gmail.com')
 
+# Let a list of emails opt out from the topic at once
+bulk_opt_out(SECOND_TOPIC, ['first@example.com', 'second@example.com'], protocol='email')
+
 
 # Delete the topic
 def delete_topic(topic_name):
     # Get the topic arn
-    topic_name_arn = topic_arn[topic_name]
+    topic_name_arn = topic_registry.arn(topic_name)
     # Delete the topic using the topic's arn
     sns.delete_topic(TopicArn=topic_name_arn)
+    subscription_index.invalidate(topic_name_arn)
+    topic_registry.forget(topic_name)
     
 delete_topic(TOPIC_NAME)
 
@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''
+
+Evaluating SNS subscription filter policies before publishing
+
+- Compiling the filter policies of the subscriptions once into an index by message attribute
+- Exact string and number conditions are looked up in a dictionary, the other conditions
+  (prefix, suffix, equals-ignore-case, anything-but, numeric ranges, exists) are only evaluated
+  for the policies whose exact conditions matched
+- Finding the subscriptions which would receive a message from its message attributes
+- Benchmarking the matching throughput against evaluating every policy when run as a script
+
+'''
+
+# Import necessary packages
+import json
+import random
+import time
+from collections import Counter
+
+
+# The numeric comparison operators of a 'numeric' condition
+NUMERIC_OPERATORS = {
+    '=': lambda value, bound: value == bound,
+    '>': lambda value, bound: value > bound,
+    '>=': lambda value, bound: value >= bound,
+    '<': lambda value, bound: value < bound,
+    '<=': lambda value, bound: value <= bound
+}
+
+
+# Function to tell the value kind of a condition or attribute value, strings and numbers never match each other
+def _value_key(value):
+    if isinstance(value, bool):
+        return ('s', str(value).lower())
+    if isinstance(value, (int, float)):
+        return ('n', float(value))
+    return ('s', value)
+
+
+# Create a matcher for the conditions of one attribute in a filter policy, for example
+#
+#   ['red', {'prefix': 'bl'}, {'numeric': ['>', 0, '<=', 5]}]
+#
+# matches if any of the conditions matches one of the values of the attribute
+class KeyMatcher:
+
+    def __init__(self, conditions):
+        if not isinstance(conditions, list):
+            conditions = [conditions]
+        # The exact values, looked up in a dictionary by the index
+        self.exact = set()
+        # The other conditions as functions of a single value
+        self.predicates = []
+        # None when the attribute has to be present, False when it has to be absent
+        self.exists = None
+        for condition in conditions:
+            if not isinstance(condition, dict):
+                self.exact.add(_value_key(condition))
+            elif set(condition) == {'exists'}:
+                self.exists = bool(condition['exists'])
+            else:
+                self.predicates.append(self._compile(condition))
+
+    # Compile an operator condition into a function of a single value
+    def _compile(self, condition):
+        if len(condition) != 1:
+            raise ValueError('Unsupported condition {}'.format(condition))
+        operator, operand = next(iter(condition.items()))
+        if operator == 'prefix':
+            return lambda value: value[0] == 's' and value[1].startswith(operand)
+        if operator == 'suffix':
+            return lambda value: value[0] == 's' and value[1].endswith(operand)
+        if operator == 'equals-ignore-case':
+            lowered = operand.lower()
+            return lambda value: value[0] == 's' and value[1].lower() == lowered
+        if operator == 'numeric':
+            checks = [(NUMERIC_OPERATORS[operand[i]], float(operand[i + 1])) for i in range(0, len(operand), 2)]
+            return lambda value: value[0] == 'n' and all(check(value[1], bound) for check, bound in checks)
+        if operator == 'anything-but':
+            if isinstance(operand, dict):
+                inner = self._compile(operand)
+                return lambda value: not inner(value)
+            excluded = {_value_key(item) for item in (operand if isinstance(operand, list) else [operand])}
+            return lambda value: value not in excluded
+        raise ValueError('Unsupported operator {}'.format(operator))
+
+    # Whether the conditions are only exact values which the index can look up
+    def is_exact(self):
+        return not self.predicates and self.exists is None
+
+    # Check the values of the attribute, None for an absent attribute
+    def matches(self, values):
+        if values is None:
+            return self.exists is False
+        if self.exists is not None:
+            return self.exists
+        return any(value in self.exact or any(predicate(value) for predicate in self.predicates) for value in values)
+
+
+# Create a matcher for an attribute with several conditions which all have to match, for example
+#
+#   {'region': ['eu-west-1', 'eu-central-1'], '$or': [{'region': [{'prefix': 'eu-c'}]}, {'tier': ['gold']}]}
+#
+# where the first alternative needs both conditions on 'region'
+class AllMatcher:
+
+    def __init__(self, matchers):
+        self.matchers = matchers
+
+    # The index only looks up single conditions, these are evaluated
+    def is_exact(self):
+        return False
+
+    def matches(self, values):
+        return all(matcher.matches(values) for matcher in self.matchers)
+
+
+# Function to combine the conditions of two alternatives, the conditions of the same attribute all have to match
+def _merge(alternative, option):
+    merged = {key: list(condition_lists) for key, condition_lists in alternative.items()}
+    for key, condition_lists in option.items():
+        merged.setdefault(key, []).extend(condition_lists)
+    return merged
+
+
+# Function to expand a filter policy into the alternatives it matches, each a dictionary of the lists of conditions
+# of every attribute. A policy with '$or' matches if any of its alternatives matches, the conditions of an '$or'
+# branch on an attribute which already has conditions are added to them instead of replacing them
+def expand_policy(policy):
+    alternatives = [{}]
+    for key, conditions in policy.items():
+        if key == '$or':
+            alternatives = [_merge(alternative, option) for alternative in alternatives
+                            for branch in conditions for option in expand_policy(branch)]
+        elif isinstance(conditions, dict):
+            raise ValueError('Nested filter policies only apply to the message body')
+        else:
+            alternatives = [_merge(alternative, {key: [conditions]}) for alternative in alternatives]
+    return alternatives
+
+
+# Function to compile an alternative of a policy into a matcher for every attribute
+def compile_alternative(alternative):
+    matchers = {}
+    for key, condition_lists in alternative.items():
+        compiled = [KeyMatcher(conditions) for conditions in condition_lists]
+        matchers[key] = compiled[0] if len(compiled) == 1 else AllMatcher(compiled)
+    return matchers
+
+
+# Function to read the SNS message attributes into the values compared with the conditions
+def attribute_values(attributes):
+    values = {}
+    for name, attr in (attributes or {}).items():
+        data_type = attr['DataType']
+        if data_type.startswith('Number'):
+            values[name] = [('n', float(attr['StringValue']))]
+        elif data_type == 'String.Array':
+            values[name] = [_value_key(item) for item in json.loads(attr['StringValue'])]
+        elif data_type.startswith('String'):
+            values[name] = [('s', attr['StringValue'])]
+        # Binary attributes are never matched by a filter policy
+    return values
+
+
+# Create an index of the filter policies of many subscriptions
+#
+# The policies are given as (owner, policy) pairs, the owner is usually the subscription arn and the policy
+# the 'FilterPolicy' attribute as a JSON string or a dictionary. A subscription without a policy, with a policy
+# on the message body or with a policy which can not be compiled receives every message.
+#
+# The exact conditions of all the policies are looked up by attribute and value first. Only the alternatives
+# whose exact conditions are all satisfied, and the alternatives without any, have their other conditions evaluated.
+class FilterPolicyIndex:
+
+    def __init__(self, policies):
+        # The owners receiving every message
+        self.match_all = set()
+        # The owner, the number of exact conditions and the other conditions of every alternative
+        self.alternative_owner = []
+        self.alternative_exact = []
+        self.alternative_matchers = []
+        # The alternatives without exact conditions, always evaluated
+        self.unindexed = []
+        # The alternative of every exact condition, by the id of the condition
+        self.key_alternative = []
+        # The ids of the exact conditions by attribute and value
+        self.exact = {}
+        for owner, policy in policies:
+            self.add(owner, policy)
+
+    # Add the filter policy of a subscription to the index
+    def add(self, owner, policy, scope='MessageAttributes'):
+        if not policy or scope != 'MessageAttributes':
+            self.match_all.add(owner)
+            return
+        try:
+            alternatives = expand_policy(json.loads(policy) if isinstance(policy, str) else policy)
+            compiled = [compile_alternative(alternative) for alternative in alternatives]
+        except (ValueError, KeyError, TypeError, IndexError):
+            # Better to publish a message nobody receives than to drop one a subscriber wanted
+            self.match_all.add(owner)
+            return
+        for matchers in compiled:
+            alternative = len(self.alternative_owner)
+            self.alternative_owner.append(owner)
+            exact_count = 0
+            others = []
+            for key, matcher in matchers.items():
+                if matcher.is_exact():
+                    key_id = len(self.key_alternative)
+                    self.key_alternative.append(alternative)
+                    exact_count += 1
+                    for value in matcher.exact:
+                        self.exact.setdefault(key, {}).setdefault(value, []).append(key_id)
+                else:
+                    others.append((key, matcher))
+            self.alternative_exact.append(exact_count)
+            self.alternative_matchers.append(others)
+            if not exact_count:
+                self.unindexed.append(alternative)
+
+    # Get the owners whose filter policy matches the message attributes
+    def match(self, attributes):
+        values = attribute_values(attributes)
+        satisfied = set()
+        for name, attr_values in values.items():
+            exact = self.exact.get(name)
+            if exact:
+                for value in attr_values:
+                    satisfied.update(exact.get(value, ()))
+        counts = Counter(self.key_alternative[key_id] for key_id in satisfied)
+        candidates = [alternative for alternative, count in counts.items() if count == self.alternative_exact[alternative]]
+        owners = set(self.match_all)
+        for alternative in candidates + self.unindexed:
+            owner = self.alternative_owner[alternative]
+            if owner not in owners and all(matcher.matches(values.get(key))
+                                           for key, matcher in self.alternative_matchers[alternative]):
+                owners.add(owner)
+        return owners
+
+    # Check whether any subscription would receive a message with the attributes
+    def any_match(self, attributes):
+        return bool(self.match_all) or bool(self.match(attributes))
+
+
+# Function to match the message attributes against every policy one after the other, the baseline of the benchmark
+def match_each(policies, attributes):
+    values = attribute_values(attributes)
+    owners = set()
+    for owner, alternatives in policies:
+        for matchers in alternatives:
+            if all(matcher.matches(values.get(key)) for key, matcher in matchers.items()):
+                owners.add(owner)
+                break
+    return owners
+
+
+# Function to create a random filter policy over the attributes of the benchmark messages
+def random_policy(events, regions):
+    policy = {'event': random.sample(events, random.randint(1, 3))}
+    choice = random.random()
+    if choice < 0.3:
+        policy['region'] = [{'prefix': random.choice(regions)[:4]}]
+    elif choice < 0.6:
+        low = random.randint(0, 900)
+        policy['price'] = [{'numeric': ['>=', low, '<', low + random.randint(10, 100)]}]
+    elif choice < 0.8:
+        policy['tier'] = [{'anything-but': ['free']}]
+    else:
+        policy['$or'] = [{'region': random.sample(regions, 2)}, {'tier': ['gold']}]
+    return policy
+
+
+# Function to create random message attributes for the benchmark
+def random_attributes(events, regions):
+    return {
+        'event': {'DataType': 'String', 'StringValue': random.choice(events)},
+        'region': {'DataType': 'String', 'StringValue': random.choice(regions)},
+        'price': {'DataType': 'Number', 'StringValue': str(random.randint(0, 1000))},
+        'tier': {'DataType': 'String', 'StringValue': random.choice(['free', 'silver', 'gold'])}
+    }
+
+
+# Function to measure how many messages per second are matched against a number of policies
+def benchmark(policy_count, message_count=2000, seed=1):
+    random.seed(seed)
+    events = ['event-{}'.format(i) for i in range(200)]
+    regions = ['us-east-1', 'us-west-2', 'eu-west-1', 'eu-central-1', 'ap-south-1']
+    policies = [('sub-{}'.format(i), random_policy(events, regions)) for i in range(policy_count)]
+    messages = [random_attributes(events, regions) for _ in range(message_count)]
+
+    start = time.perf_counter()
+    index = FilterPolicyIndex(policies)
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    indexed = [index.match(attributes) for attributes in messages]
+    index_time = time.perf_counter() - start
+
+    compiled = [(owner, [compile_alternative(alternative) for alternative in expand_policy(policy)])
+                for owner, policy in policies]
+    start = time.perf_counter()
+    each = [match_each(compiled, attributes) for attributes in messages]
+    each_time = time.perf_counter() - start
+
+    if indexed != each:
+        raise AssertionError('The index and the baseline disagree')
+    return {
+        'policies': policy_count,
+        'build_ms': build_time * 1000,
+        'index_per_sec': message_count / index_time,
+        'each_per_sec': message_count / each_time,
+        'matched_per_msg': sum(len(owners) for owners in indexed) / message_count
+    }
+
+
+if __name__ == '__main__':
+    for policy_count in [100, 1000, 5000, 10000]:
+        result = benchmark(policy_count)
+        print('policies={policies:>5} build={build_ms:>7.1f}ms indexed/s={index_per_sec:>8.0f} '
+              'each policy/s={each_per_sec:>8.0f} matches/msg={matched_per_msg:.1f}'.format(**result))
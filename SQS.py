@@ -15,7 +15,16 @@ Following are the actions done in the example
 - Update the queue attributes
 - Add permissions to the SQS service
 - Sending messages and also by batches
+- Sending any number of messages as batches of up to 10 messages and 256 KB in parallel
 - Receiving and deleting the messages
+- Long polling for messages and deleting them in batches
+- Caching the queue urls and arns so the messages are sent with a single call
+- Handling messages on a pool of workers while extending the visibility of the messages in progress
+- Buffering single messages into batches sent in the background
+- Storing the bodies of large messages in S3 and sending a pointer instead
+- Moving the messages of a dead letter queue back to their source queue in parallel
+- Spreading the messages of a fifo queue over message groups with high throughput mode and optional content based deduplication
+- Encoding the message bodies with a compact codec
 - Deleting the queues
 
 '''
@@ -23,13 +32,103 @@ Following are the actions done in the example
 # Import the necessary packages
 import boto3
 import json
+import hashlib
 from uuid import uuid4
+import time
+import random
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
+from botocore.exceptions import ClientError, BotoCoreError
+import Codec
+import S3_Payload
+import Batching
 
 
 # Create a sqs client object with the region name set
 sqs = boto3.client('sqs', region_name='us-east-2')
 
 
+# Error codes sqs returns for a queue which does not exist
+MISSING_QUEUE_CODES = ('AWS.SimpleQueueService.NonExistentQueue', 'QueueDoesNotExist')
+
+# Attributes fixed when the queue is created, the only ones which are cached
+IMMUTABLE_ATTRIBUTES = ('QueueArn', 'FifoQueue', 'CreatedTimestamp')
+
+
+# Create a cache of the queue urls and of the attributes which never change, like the queue arn
+# Entries expire after the ttl and are dropped when the queue is deleted or turns out not to exist
+class QueueResolver:
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.urls = {}
+        self.attrs = {}
+        self.lock = threading.Lock()
+
+    # Get a value from a cache if it has not expired yet
+    def _get(self, cache, key):
+        with self.lock:
+            entry = cache.get(key)
+        if entry and entry[1] > time.time():
+            return entry[0]
+        return None
+
+    # Store the url of a queue, for example the one returned when the queue is created
+    def remember(self, queue_name, queue_url):
+        with self.lock:
+            self.urls[queue_name] = (queue_url, time.time() + self.ttl)
+
+    # Get the url of a queue, asking sqs only when it is not cached
+    def url(self, queue_name):
+        queue_url = self._get(self.urls, queue_name)
+        if queue_url is None:
+            queue_url = sqs.get_queue_url(QueueName=queue_name)['QueueUrl']
+            self.remember(queue_name, queue_url)
+        return queue_url
+
+    # Get an attribute of a queue, the ones which do not change are cached and the others are always asked from sqs
+    def attribute(self, queue_name, attr_name):
+        value = self._get(self.attrs, (queue_name, attr_name))
+        if value is None:
+            response = sqs.get_queue_attributes(QueueUrl=self.url(queue_name), AttributeNames=[attr_name])
+            value = response['Attributes'][attr_name]
+            if attr_name in IMMUTABLE_ATTRIBUTES:
+                with self.lock:
+                    self.attrs[(queue_name, attr_name)] = (value, time.time() + self.ttl)
+        return value
+
+    # Get the arn of a queue
+    def arn(self, queue_name):
+        return self.attribute(queue_name, 'QueueArn')
+
+    # Drop the cached values of a queue, or of all the queues if no name is given
+    def invalidate(self, queue_name=None):
+        with self.lock:
+            if queue_name is None:
+                self.urls.clear()
+                self.attrs.clear()
+                return
+            self.urls.pop(queue_name, None)
+            for key in [key for key in self.attrs if key[0] == queue_name]:
+                del self.attrs[key]
+
+
+# The resolver shared by all the functions below
+queue_resolver = QueueResolver()
+
+
+# Context manager dropping the cached values of a queue when a call finds out the queue does not exist
+@contextmanager
+def queue_errors(queue_name):
+    try:
+        yield
+    except ClientError as e:
+        if e.response['Error']['Code'] in MISSING_QUEUE_CODES:
+            queue_resolver.invalidate(queue_name)
+        raise
+
+
 QUEUE_NAME = 'First-Queue'
 # Create a standard sqs queue
 sqs_queue = sqs.create_queue(QueueName=QUEUE_NAME)
@@ -39,6 +138,8 @@ print(sqs_queue)
 
 # Get the url for the standard queue
 QUEUE_URL = sqs_queue['QueueUrl']
+# Remember the url so it does not have to be looked up again
+queue_resolver.remember(QUEUE_NAME, QUEUE_URL)
 
 # Naming convention for the sqs fifo queue states that the name should end with '.fifo'
 FIFO_QUEUE = 'First-FIFO-Queue.fifo'
@@ -52,6 +153,37 @@ print(fifo_queue)
 
 # Get the fifo queue url
 fifo_url = fifo_queue['QueueUrl']
+queue_resolver.remember(FIFO_QUEUE, fifo_url)
+
+
+# Attributes of a fifo queue in high throughput mode, the throughput limit and the deduplication
+# apply to each message group instead of the whole queue, so the groups are sent and received in parallel
+HIGH_THROUGHPUT_FIFO = {
+    'FifoQueue': 'true',
+    'DeduplicationScope': 'messageGroup',
+    'FifoThroughputLimit': 'perMessageGroupId'
+}
+
+
+# Function to get the attributes for creating a fifo queue, optionally in high throughput mode
+def fifo_queue_attributes(high_throughput=False):
+    if high_throughput:
+        return dict(HIGH_THROUGHPUT_FIFO)
+    return {'FifoQueue': 'true'}
+
+
+# Function to get the message group of an ordering key, the keys are hashed over a fixed number of groups
+# The messages with the same key stay in order while the messages of different groups are handled in parallel
+def fifo_group_id(ordering_key, group_count, prefix='group'):
+    digest = hashlib.md5(str(ordering_key).encode('utf-8')).digest()
+    return '{}-{}'.format(prefix, int.from_bytes(digest[:8], 'big') % group_count)
+
+
+# Function to get the message group of a message, from its ordering key if one is given or else the fixed group id
+def msg_group(msg_group_id=None, ordering_key=None, group_count=1):
+    if ordering_key is None:
+        return msg_group_id
+    return fifo_group_id(ordering_key, group_count, prefix=msg_group_id or 'group')
 
 print(response)
 
@@ -61,10 +193,11 @@ def get_queue_attr(queue_name, *args):
     attr_list = []
     for arg in args:
         attr_list.append(arg)
-    # Find the queue url using the queue name on the function 'get_queue_url'
-    queue_url = sqs.get_queue_url(QueueName=queue_name)['QueueUrl']
+    # Find the queue url using the queue name, it is only looked up when it is not cached
+    queue_url = queue_resolver.url(queue_name)
     # Get the attributes of the queue using the queue url and passing to the list of wanted queue attributes 
-    queue_attr = sqs.get_queue_attributes(QueueUrl=queue_url, AttributeNames=attr_list)
+    with queue_errors(queue_name):
+        queue_attr = sqs.get_queue_attributes(QueueUrl=queue_url, AttributeNames=attr_list)
     return queue_attr
 
 
@@ -74,15 +207,16 @@ print(fifo_queue_attr)
 
 
 # Function to create a standard or fifo queue along with a dead letter queue associated with it
-def queue_with_optional_dead_letter(queue_name, dead_letter=None, fifo=False):
+# A fifo queue can be created in high throughput mode
+def queue_with_optional_dead_letter(queue_name, dead_letter=None, fifo=False, high_throughput=False):
     # Variable to determine whether a dead letter queue is needed
     dead_letter_required = False
     # If the dead letter queue is needed   
     if dead_letter:
         # Set the variable dead_letter_required to true
         dead_letter_required = True
-        # Get the dead letter queue's arn 
-        dead_letter_arn = get_queue_attr(dead_letter, 'QueueArn')['Attributes']['QueueArn']
+        # Get the dead letter queue's arn, cached as the arn of a queue never changes
+        dead_letter_arn = queue_resolver.arn(dead_letter)
         # Define the redrive policy attribute to passed to the 'create_queue' function
         redrive_policy = {
             'deadLetterTargetArn': dead_letter_arn, # Make this url as the dead letter queue for the queue to created
@@ -91,16 +225,18 @@ def queue_with_optional_dead_letter(queue_name, dead_letter=None, fifo=False):
     # If both dead letter queue is and the queue has to be fifo
     if dead_letter_required and fifo:
         # Create the queue with the redrive policy attributes and and the attribute to make it fifo
-        queue = sqs.create_queue(QueueName=queue_name, Attributes={'FifoQueue': 'true', 'RedrivePolicy': json.dumps(redrive_policy)})
+        queue = sqs.create_queue(QueueName=queue_name, Attributes=dict(fifo_queue_attributes(high_throughput),
+                                                                       RedrivePolicy=json.dumps(redrive_policy)))
     # If the dead letter queue is required but not a fifo queue
     elif dead_letter_required and not fifo:
         queue = sqs.create_queue(QueueName=queue_name, Attributes={'RedrivePolicy': json.dumps(redrive_policy)})
     # A dead letter queue is not required but it has to be fifo
     elif not dead_letter_required and fifo:
-        queue = sqs.create_queue(QueueName=queue_name, Attributes={'FifoQueue': 'true'})
+        queue = sqs.create_queue(QueueName=queue_name, Attributes=fifo_queue_attributes(high_throughput))
     # Neither dead letter queue required nor is fifo
     else:
         queue = sqs.create_queue(QueueName=queue_name)
+    queue_resolver.remember(queue_name, queue['QueueUrl'])
     return queue
 
 
@@ -114,6 +250,12 @@ fifo_queue_dead_letter = queue_with_optional_dead_letter('Fifo_and_dead_letter.f
 
 print(fifo_queue_dead_letter)
 
+# Create a fifo queue in high throughput mode
+HIGH_THROUGHPUT_QUEUE = 'High-Throughput-Queue.fifo'
+high_throughput_queue = queue_with_optional_dead_letter(HIGH_THROUGHPUT_QUEUE, fifo=True, high_throughput=True)
+
+print(high_throughput_queue)
+
 
 # Create a function to list all the queues with an option to filter out the queue by  a prefix
 def list_queue(prefix=None):
@@ -141,43 +283,63 @@ def update_queue_attr(queue_name, key_list, value_list):
     # Create a dictionary with the attribute keys and values
     attr_dict = dict(zip(key_list, value_list))
     # Get the url of the queue
-    queue_url = sqs.get_queue_url(QueueName=queue_name)['QueueUrl']
+    queue_url = queue_resolver.url(queue_name)
     # Update the attributes by passing in the attriubtes dictionary
-    update_response = sqs.set_queue_attributes(QueueUrl=queue_url, Attributes=attr_dict)
+    with queue_errors(queue_name):
+        update_response = sqs.set_queue_attributes(QueueUrl=queue_url, Attributes=attr_dict)
     return update_response
 
 
 # Update the values of the 'DelaySeconds' and 'MaximumMessageSize' to 10 and 30000 respectively
 update_response = update_queue_attr(QUEUE_NAME, ['DelaySeconds', 'MaximumMessageSize'], ['10', '30000'])
+
+# Switch the existing fifo queue to high throughput mode
+update_fifo_response = update_queue_attr(FIFO_QUEUE, ['DeduplicationScope', 'FifoThroughputLimit'],
+                                         [HIGH_THROUGHPUT_FIFO['DeduplicationScope'], HIGH_THROUGHPUT_FIFO['FifoThroughputLimit']])
 print(update_response)
 
 
-# Function to retreive the url of the queue using the queue name
+# Function to retreive the url of the queue using the queue name, the url is cached by the resolver
 def queue_name_to_url(queue_name):
-    queue_url = sqs.get_queue_url(QueueName=queue_name)['QueueUrl']
+    queue_url = queue_resolver.url(queue_name)
     return queue_url
 
 # Adding permission for sqs to send and receive messages
 add_permission_response = sqs.add_permission(QueueUrl=queue_name_to_url(QUEUE_NAME), # Queue Url
-                                             Label='AddPermissionForAll,   # Unique string Id
+                                             Label='AddPermissionForAll',   # Unique string Id
                                              AWSAccounIds=['*'],           # All the users 
                                              Actions=['*'])                # All the actions
   
   
-# Function to send message to the sqs queue
-def send_msg(queue_name, msg, message_group_id=None, fifo=False): 
+# Function to send message to the sqs queue, optionally encoding the message with a codec
+# With a payload bucket a message above 256 KB is stored in the bucket and a pointer to it is sent instead
+# With an ordering key the message of a fifo queue goes into one of 'group_count' groups picked by the key
+# With 'content_dedup' the deduplication id of a fifo message is the hash of its body, so sending the
+# same body again within 5 minutes does not create a second message
+def send_msg(queue_name, msg, message_group_id=None, fifo=False, codec=None, payload_bucket=None,
+             ordering_key=None, group_count=1, content_dedup=False): 
     # Get the url of the queue
     queue_url = queue_name_to_url(queue_name)
+    # Encode the message as text with the codec, the receiver detects the codec from the body
+    if codec:
+        msg = Codec.encode_text(msg, codec)
+    # The deduplication id is taken from the body before it is replaced by a pointer with a random key
+    msg_dedup_id = Batching.dedup_id(msg, content_dedup)
+    attributes = {}
+    if payload_bucket:
+        msg, attributes = S3_Payload.offload(msg, payload_bucket)
     # If message has to be sent to a standard queue
-    if not fifo:
-        # Send the message using the queue url and pass in the message to the 'MessageBody' parameter
-        send_response = sqs.send_message(QueueUrl=queue_url, MessageBody=msg)
-    else:
-        # If the message is to be sent to a fifo queue
-        send_response = sqs.send_message(QueueUrl=queue_url, # Queue url
-                                         MessageBody=msg,    # Message
-                                         MessageGroupId=message_group_id,     # Group id of the message in string format
-                                         MessageDeduplicationId=str(uuid4())) # A random unique message deduplication id as string 
+    with queue_errors(queue_name):
+        if not fifo:
+            # Send the message using the queue url and pass in the message to the 'MessageBody' parameter
+            send_response = sqs.send_message(QueueUrl=queue_url, MessageBody=msg, MessageAttributes=attributes)
+        else:
+            # If the message is to be sent to a fifo queue
+            send_response = sqs.send_message(QueueUrl=queue_url, # Queue url
+                                             MessageBody=msg,    # Message
+                                             MessageAttributes=attributes,        # Attributes, holding the payload size of a pointer
+                                             MessageGroupId=msg_group(message_group_id, ordering_key, group_count), # Group id of the message in string format
+                                             MessageDeduplicationId=msg_dedup_id) # A random id or the hash of the message as deduplication id 
     return send_response
 
 
@@ -188,38 +350,134 @@ msg_to_std = send_msg(QUEUE_NAME, 'Message to the standard queue')
 # Send message to fifo queue with message group id as an argument
 msg_to_fifo = send_msg(FIFO_QUEUE, 'Message to the fifo queue', message_group_id='fifo_1', fifo=True)
 
+# Send a reading of a thing to the high throughput fifo queue, the readings of a thing stay in order in one of 16 groups
+msg_to_group = send_msg(HIGH_THROUGHPUT_QUEUE, 'Reading of thing-7', fifo=True, ordering_key='thing-7', group_count=16)
+
+# Send a reading to the standard queue encoded with the compact sensor codec
+msg_encoded = send_msg(QUEUE_NAME, {'prop': 87, 'timestamp': 1577836800}, codec='sensor')
+
+# Send a message above the 256 KB limit, stored in a bucket and sent as a pointer
+msg_large = send_msg(QUEUE_NAME, 'x' * 300 * 1024, payload_bucket='sqs-large-payloads')
+
+
+# Limits of a single 'send_message_batch' call set by sqs
+MAX_BATCH_ENTRIES = 10             # At most 10 messages in a batch
+MAX_BATCH_BYTES = 256 * 1024       # At most 256 KB for all the messages of a batch together
+
+
+# Function to compute the size sqs counts for a message, the body and its message attributes in UTF-8 bytes
+def msg_size(entry):
+    return S3_Payload.payload_size(entry['MessageBody'], entry.get('MessageAttributes'))
 
-# Message to send a batch of messages
-def send_msg_batch(queue_name, msg_list, msg_group_id=None, fifo=False):
+
+# Function to pack the entries into as few batches as possible, returns lists of entry positions
+# The entries of a fifo queue keep their order and only go into the last batch, the others are packed
+# largest first into the first of the most recent open batches with room for them
+def pack_batches(entries, keep_order=False, open_limit=32):
+    sizes = [msg_size(entry) for entry in entries]
+    order = list(range(len(entries)))
+    if not keep_order:
+        order.sort(key=lambda i: sizes[i], reverse=True)
+    batches = []
+    # The batches which can still take messages, as [positions, size] pairs
+    open_batches = []
+    for i in order:
+        candidates = open_batches[-1:] if keep_order else open_batches
+        for batch in candidates:
+            if batch[1] + sizes[i] <= MAX_BATCH_BYTES:
+                batch[0].append(i)
+                batch[1] += sizes[i]
+                # A batch with 10 messages is full
+                if len(batch[0]) == MAX_BATCH_ENTRIES:
+                    open_batches.remove(batch)
+                break
+        else:
+            batch = [[i], sizes[i]]
+            batches.append(batch[0])
+            open_batches.append(batch)
+            # Only a few open batches are searched, so packing millions of messages stays linear
+            if len(open_batches) > open_limit:
+                open_batches.pop(0)
+    return batches
+
+
+# Function to send a batch of entries, retrying only the entries which failed on the side of sqs
+def send_entries(queue_url, entries, max_retries=5, backoff=0.1):
+    return Batching.send_batch(lambda pending: sqs.send_message_batch(QueueUrl=queue_url, Entries=pending),
+                               entries, max_retries, backoff)
+
+
+# Function to send any number of messages as batches, the batches are sent in parallel by a pool of threads
+# Returns a result for each message in the order of the list, the 'MessageId' on success or the 'Code' of the error
+# With a payload bucket the messages above 256 KB are uploaded to the bucket in parallel and sent as pointers
+#
+# The messages of a fifo queue go into the group 'msg_group_id', or with a list of ordering keys, one for each
+# message, into one of 'group_count' groups picked by the key. The groups are spread over the threads, each thread
+# sends its batches one after the other, so the messages of a group keep their order while the groups are sent in parallel.
+# With 'content_dedup' the deduplication ids are the hashes of the bodies.
+def send_msg_batch(queue_name, msg_list, msg_group_id=None, fifo=False, codec=None, max_workers=8, max_retries=5,
+                   payload_bucket=None, ordering_keys=None, group_count=1, content_dedup=False):
     # Get the url of the queue using the queue name
     queue_url = queue_name_to_url(queue_name)
-    # Create an empty list to hold the value for 'Entries' parameter for each message 
-    msg_dict_list = []
-    
-    # If the message is to fifo queue
-    if fifo:
-        for msg in msg_list:
-            # Do this for each message
-            msg_dict_list.append(
-                             {
-                                  'Id': str(uuid4()),  # A unique for each message
-                                  'MessageBody': msg,  # The message
-                                  'MessageGroupId': msg_group_id,        # Message group id
-                                  'MessageDeduplicationId': str(uuid4()) # Message deduplication id
-                                       
-                             }
-                    )
-    
-    # If the message is to a standard queue
+    # Encode the messages as text with the codec
+    if codec:
+        msg_list = [Codec.encode_text(msg, codec) for msg in msg_list]
+    ordering_keys = ordering_keys or [None] * len(msg_list)
+    offloaded = [(msg, {}) for msg in msg_list]
+    if payload_bucket:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            offloaded = list(executor.map(lambda msg: S3_Payload.offload(msg, payload_bucket), msg_list))
+    # Create the entry for each message with its position in the list as the id
+    entries = []
+    for i, (msg, attributes) in enumerate(offloaded):
+        entry = {'Id': str(i), 'MessageBody': msg}
+        if attributes:
+            entry['MessageAttributes'] = attributes
+        if fifo:
+            entry['MessageGroupId'] = msg_group(msg_group_id, ordering_keys[i], group_count)   # Message group id
+            entry['MessageDeduplicationId'] = Batching.dedup_id(msg_list[i], content_dedup)   # Message deduplication id
+        entries.append(entry)
+    results = [None] * len(entries)
+    # A message above the limit can never be sent
+    sendable = []
+    for entry in entries:
+        if msg_size(entry) > MAX_BATCH_BYTES:
+            results[int(entry['Id'])] = {'Id': entry['Id'], 'Code': 'MessageTooLong', 'SenderFault': True}
+        else:
+            sendable.append(entry)
+    if not fifo:
+        # Every batch is sent on its own
+        lanes = [[[sendable[i] for i in batch]] for batch in pack_batches(sendable)]
     else:
-        for msg in msg_list:
-            msg_dict_list.append({
-                'Id': str(uuid4()), # Unique message id
-                'MessageBody': msg  # Message
-            })
-    # Send the messagses as batch using the queue url and the entries list
-    send_response = sqs.send_message_batch(QueueUrl=queue_url, Entries=msg_dict_list)
-    return send_response
+        # The messages of a group always go to the same lane, a lane keeps the order of its messages
+        lane_entries = {}
+        for entry in sendable:
+            lane = fifo_group_id(entry['MessageGroupId'], max_workers)
+            lane_entries.setdefault(lane, []).append(entry)
+        lanes = [[[entries[i] for i in batch] for batch in pack_batches(entries, keep_order=True)]
+                 for entries in lane_entries.values()]
+
+    # Send the batches of a lane one after the other
+    # After a failure in a fifo lane the rest of the lane is not sent, it would overtake the failed messages of its groups
+    def send_lane(batches):
+        lane_results = {}
+        for n, batch in enumerate(batches):
+            batch_results = send_entries(queue_url, batch, max_retries)
+            lane_results.update(batch_results)
+            if fifo and any('MessageId' not in result for result in batch_results.values()):
+                for later in batches[n + 1:]:
+                    lane_results.update((entry['Id'], Batching.unsent(entry['Id'])) for entry in later)
+                break
+        return lane_results
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for lane_results in executor.map(send_lane, lanes):
+            for entry_id, result in lane_results.items():
+                results[int(entry_id)] = result
+    # The failed calls are in the results instead of raising, a missing queue still drops its cached url
+    if any(result.get('Code') in MISSING_QUEUE_CODES for result in results):
+        queue_resolver.invalidate(queue_name)
+    return results
             
     
 # Hold the messages in a list
@@ -229,6 +487,170 @@ msg_list = ['First msg', 'Second msg', 'Third msg', 'Fourth msg', 'Fifth msg', '
 # Send the batch of messages to a fifo queue
 batch_msg_to_fifo = send_msg_batch(FIFO_QUEUE, msg_list, msg_group_id='fifo_msg', fifo=True)
 
+# Send a thousand messages to the standard queue, they are split into batches sent in parallel
+bulk_results = send_msg_batch(QUEUE_NAME, ['Bulk msg {}'.format(i) for i in range(1000)])
+
+# Send the readings of a hundred things to the high throughput fifo queue, the things are spread over 16 groups
+# sent in parallel and the readings of each thing stay in order. Every reading has its own sequence number,
+# so a reading sent again after a failure is deduplicated by the hash of its body
+readings = [{'thing': 'thing-{}'.format(i % 100), 'prop': random.randint(40, 120), 'seq': i} for i in range(1000)]
+fifo_results = send_msg_batch(HIGH_THROUGHPUT_QUEUE, [json.dumps(reading) for reading in readings], fifo=True,
+                              ordering_keys=[reading['thing'] for reading in readings], group_count=16,
+                              content_dedup=True)
+print(sum(1 for result in bulk_results if 'MessageId' in result), 'messages sent')
+
+
+# Create a producer which combines single messages into 'send_message_batch' calls sent in the background
+#
+# 'send' only adds the message to a buffer and returns a future, the buffer is sent once it holds
+# 10 messages or 256 KB or once the oldest message has waited for the linger time. The future
+# resolves to the result of the message with its 'MessageId' or raises the error sqs returned.
+# With a payload bucket the messages above 256 KB are stored in the bucket before they are buffered.
+# The messages of a fifo queue sent with an ordering key go into one of 'group_count' groups picked by the key,
+# with 'content_dedup' their deduplication ids are the hashes of the bodies.
+class BufferedProducer:
+
+    def __init__(self, queue_name, linger=0.05, max_workers=4, fifo=False, msg_group_id=None, codec=None, max_retries=5,
+                 payload_bucket=None, group_count=1, content_dedup=False):
+        self.queue_name = queue_name
+        self.queue_url = queue_name_to_url(queue_name)
+        self.linger = linger
+        self.fifo = fifo
+        self.msg_group_id = msg_group_id
+        self.codec = codec
+        self.max_retries = max_retries
+        self.payload_bucket = payload_bucket
+        self.group_count = group_count
+        self.content_dedup = content_dedup
+        # The entries waiting in the buffer with their futures and their size
+        self.buffer = []
+        self.buffer_bytes = 0
+        self.oldest = None
+        self.lock = threading.Lock()
+        # The batches are sent by a pool of threads, a fifo queue uses a single thread to keep the order
+        self.executor = ThreadPoolExecutor(max_workers=1 if fifo else max_workers)
+        self.closed = threading.Event()
+        self.flusher = threading.Thread(target=self._linger_loop, daemon=True)
+        self.flusher.start()
+
+    # Add a message to the buffer, returns a future of its result
+    def send(self, msg, msg_group_id=None, ordering_key=None):
+        if self.closed.is_set():
+            raise RuntimeError('Producer is closed')
+        if self.codec:
+            msg = Codec.encode_text(msg, self.codec)
+        entry = {'MessageBody': msg}
+        if self.payload_bucket:
+            entry['MessageBody'], attributes = S3_Payload.offload(msg, self.payload_bucket)
+            if attributes:
+                entry['MessageAttributes'] = attributes
+        if self.fifo:
+            entry['MessageGroupId'] = msg_group(msg_group_id or self.msg_group_id, ordering_key, self.group_count)
+            entry['MessageDeduplicationId'] = Batching.dedup_id(msg, self.content_dedup)
+        future = Future()
+        size = msg_size(entry)
+        if size > MAX_BATCH_BYTES:
+            future.set_exception(ValueError('Message of {} bytes is above the 256 KB limit'.format(size)))
+            return future
+        with self.lock:
+            # Checked again under the lock, close() may have sent the last batch since the first check
+            if self.closed.is_set():
+                raise RuntimeError('Producer is closed')
+            # Send the buffer first when the message does not fit into the batch anymore
+            if self.buffer_bytes + size > MAX_BATCH_BYTES:
+                self._dispatch()
+            if not self.buffer:
+                self.oldest = time.time()
+            self.buffer.append((entry, future))
+            self.buffer_bytes += size
+            if len(self.buffer) == MAX_BATCH_ENTRIES:
+                self._dispatch()
+        return future
+
+    # Hand the buffer to the pool of threads, must be called holding the lock
+    def _dispatch(self):
+        if not self.buffer:
+            return
+        batch = self.buffer
+        self.buffer = []
+        self.buffer_bytes = 0
+        self.executor.submit(self._send, batch)
+
+    # Send a batch and resolve the futures of its messages
+    def _send(self, batch):
+        entries = []
+        for i, (entry, _) in enumerate(batch):
+            entries.append(dict(entry, Id=str(i)))
+        try:
+            with queue_errors(self.queue_name):
+                results = send_entries(self.queue_url, entries, self.max_retries)
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for i, (_, future) in enumerate(batch):
+            result = results.get(str(i), {})
+            if 'MessageId' in result:
+                future.set_result(result)
+            else:
+                future.set_exception(RuntimeError('{}: {}'.format(result.get('Code'), result.get('Message'))))
+
+    # Send the buffer in the background once the oldest message has waited for the linger time
+    def _linger_loop(self):
+        while not self.closed.wait(self.linger / 2):
+            with self.lock:
+                if self.buffer and time.time() - self.oldest >= self.linger:
+                    self._dispatch()
+
+    # Send the messages in the buffer
+    def flush(self):
+        with self.lock:
+            self._dispatch()
+
+    # Send the remaining messages and wait until all the batches are sent
+    def close(self):
+        # Set under the lock, so no message is added to the buffer after the final flush
+        with self.lock:
+            self.closed.set()
+        self.flusher.join()
+        self.flush()
+        self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Send single messages through the buffered producer, they go out as batches of 10
+with BufferedProducer(QUEUE_NAME) as buffered_producer:
+    futures = [buffered_producer.send('Buffered msg {}'.format(i)) for i in range(100)]
+print(futures[0].result())
+
+
+# Function to get the body of a received message, downloading the payload from S3 the first time if the body is a pointer
+def msg_body(msg):
+    if 'ResolvedBody' not in msg:
+        msg['ResolvedBody'] = S3_Payload.resolve(msg['Body'])
+    return msg['ResolvedBody']
+
+
+# Function to download the payloads of many received messages in parallel
+def resolve_msg_bodies(messages, max_workers=8):
+    pending = [msg for msg in messages if 'ResolvedBody' not in msg]
+    for msg, body in zip(pending, S3_Payload.resolve_all([msg['Body'] for msg in pending], max_workers)):
+        msg['ResolvedBody'] = body
+    return [msg['ResolvedBody'] for msg in messages]
+
+
+# Function to delete the payloads stored in S3 for deleted messages
+# Payloads published through a topic are shared with the other subscribers and are left to the bucket's lifecycle rules
+def delete_msg_payloads(messages):
+    bodies = [msg['Body'] for msg in messages
+              if S3_Payload.SHARED_ATTRIBUTE not in msg.get('MessageAttributes', {})]
+    return S3_Payload.delete_payloads(bodies)
+
 
 # Function to receive messages from a sqs queue
 def receive_msg(queue_name, max_msg=5, delete=False):
@@ -238,17 +660,21 @@ def receive_msg(queue_name, max_msg=5, delete=False):
     is_msg = False
     while True:
         # Receive messages continuously from the queue and set the number of messages it can receive at a time 
-        messages = sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=max_msg)
+        with queue_errors(queue_name):
+            messages = sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=max_msg, MessageAttributeNames=['All'])
         # If there are messages in queue by checking the response
         if 'Messages' in messages:
             # Retreive the message
             for msg in messages['Messages']:
                 # Set the varible to check if queue is initially empty, here queue is not empty
                 is_msg = True
-                print(msg['Body'])
+                # Decode the body if it was encoded with a codec, plain bodies are printed as they are
+                print(Codec.decode_text(msg_body(msg)))
                 # If delete flas is set, delete the message from queue using the queue url and the receipt handle
                 if delete:
                     sqs.delete_message(QueueUrl=queue_url, ReceiptHandle=msg['ReceiptHandle'])
+                    # Delete the payload stored in S3 along with the message
+                    delete_msg_payloads([msg])
             
         else:
             # After all messages are read
@@ -269,6 +695,466 @@ received_msg_std = receive_msg(QUEUE_NAME)
 received_msg_fifo = receive_msg(FIFO_QUEUE)
 
 
+# Function to delete up to 10 received messages with a single call, returns the messages which could not be deleted
+# The payloads in S3 of the deleted messages are deleted too, unless 'delete_payloads' is False
+def delete_msg_batch(queue_url, messages, delete_payloads=True):
+    if not messages:
+        return []
+    entries = [{'Id': str(i), 'ReceiptHandle': msg['ReceiptHandle']} for i, msg in enumerate(messages)]
+    response = sqs.delete_message_batch(QueueUrl=queue_url, Entries=entries)
+    failed = [messages[int(failure['Id'])] for failure in response.get('Failed', [])]
+    if delete_payloads:
+        delete_msg_payloads([msg for msg in messages if msg not in failed])
+    return failed
+
+
+# Function to receive messages with long polling, passing each message to the handler
+# The receiver keeps polling on empty responses until the stop event is set or 'max_empty_polls' empty polls in a row,
+# the messages handled without an error are deleted in batches, the others become visible again after the visibility timeout
+# With 'resolve_payloads' the payloads stored in S3 are downloaded in parallel before the messages are handled,
+# otherwise the handler gets them lazily with 'msg_body'
+def receive_msg_long_poll(queue_name, handler=None, wait_time=20, max_msg=10, delete=True, stop=None, max_empty_polls=None,
+                          resolve_payloads=False):
+    # Get the queue url
+    queue_url = queue_name_to_url(queue_name)
+    # Print the decoded message bodies if no handler is given
+    handler = handler or (lambda msg: print(Codec.decode_text(msg_body(msg))))
+    received = 0
+    empty_polls = 0
+    while not (stop and stop.is_set()):
+        # Wait up to 'wait_time' seconds for messages instead of returning at once on an empty queue
+        with queue_errors(queue_name):
+            messages = sqs.receive_message(QueueUrl=queue_url,
+                                           MaxNumberOfMessages=max_msg,   # At most 10 messages per call
+                                           WaitTimeSeconds=wait_time,     # Long polling, at most 20 seconds
+                                           MessageAttributeNames=['All']) # The attributes tell apart the payloads stored in S3
+        if 'Messages' not in messages:
+            empty_polls += 1
+            if max_empty_polls is not None and empty_polls >= max_empty_polls:
+                break
+            continue
+        empty_polls = 0
+        if resolve_payloads:
+            resolve_msg_bodies(messages['Messages'])
+        handled = []
+        for msg in messages['Messages']:
+            try:
+                handler(msg)
+                handled.append(msg)
+            except Exception as e:
+                print('Handler failed for message', msg['MessageId'], e)
+        received += len(messages['Messages'])
+        # Delete all the handled messages of the response with one call
+        if delete:
+            for msg in delete_msg_batch(queue_url, handled):
+                print('Could not delete message', msg['MessageId'])
+    return received
+
+
+# Receive the messages of the standard queue with long polling, stopping after a poll without any message
+received_count = receive_msg_long_poll(QUEUE_NAME, max_empty_polls=1)
+print(received_count, 'messages received')
+
+
+# Create a consumer which runs the handler of the messages on a pool of threads or processes
+#
+# - Poller threads long poll the queue and prefetch messages while there is room for them in the pool
+# - The visibility of the messages still being handled is extended in batches before it runs out,
+#   so a slow handler does not get its message delivered a second time
+# - Messages handled without an error are deleted in batches, the others become visible again after the timeout
+# - The messages of a fifo queue are handled one after the other within their message group and the groups
+#   in parallel, after a failed message the rest of its group is left to be received again in order
+# - On stop the messages in progress get 'drain_timeout' seconds to finish, the ones still waiting after
+#   that are not handled and become visible again after the visibility timeout
+# - A process pool needs a handler which can be pickled, like a function defined at the top of a module
+class SQSWorkerPool:
+
+    def __init__(self, queue_name, handler, workers=8, pollers=2, use_processes=False,
+                 visibility_timeout=30, prefetch=10, wait_time=20, drain_timeout=60):
+        self.queue_name = queue_name
+        self.queue_url = queue_name_to_url(queue_name)
+        self.handler = handler
+        self.workers = workers
+        self.pollers = pollers
+        self.use_processes = use_processes
+        self.visibility_timeout = visibility_timeout
+        self.wait_time = wait_time
+        self.drain_timeout = drain_timeout
+        # The number of messages received but not finished yet is kept below the workers plus the prefetch
+        self.capacity = workers + prefetch
+        self.outstanding = 0
+        self.room = threading.Condition()
+        # The messages being handled by their receipt handle and the messages waiting to be deleted
+        self.in_progress = {}
+        self.to_delete = []
+        # The messages waiting for the message in progress of their fifo message group
+        self.group_waiting = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        # The visibility heartbeat keeps running until the workers are done, so it has its own event
+        self.housekeeping_stopped = threading.Event()
+        self.threads = []
+        self.housekeeper = None
+        self.executor = None
+        # Counters of the pool
+        self.handled_count = 0
+        self.failed_count = 0
+        self.extended_count = 0
+
+    # Start the pool of workers, the pollers and the thread extending the visibility and deleting the messages
+    def start(self):
+        pool = ProcessPoolExecutor if self.use_processes else ThreadPoolExecutor
+        self.executor = pool(max_workers=self.workers)
+        for _ in range(self.pollers):
+            self.threads.append(threading.Thread(target=self._poll_loop, daemon=True))
+        self.housekeeper = threading.Thread(target=self._housekeeping_loop, daemon=True)
+        for thread in self.threads + [self.housekeeper]:
+            thread.start()
+
+    # Receive messages whenever the pool has room for a full batch of 10
+    # A failed receive gives back its room and is tried again with an exponential backoff
+    def _poll_loop(self):
+        backoff = 0.1
+        while not self.stopped.is_set():
+            with self.room:
+                while self.outstanding + 10 > self.capacity and not self.stopped.is_set():
+                    self.room.wait(0.5)
+                if self.stopped.is_set():
+                    return
+                # Reserve the room before receiving, so the other pollers do not receive into it too
+                self.outstanding += 10
+            try:
+                with queue_errors(self.queue_name):
+                    messages = sqs.receive_message(QueueUrl=self.queue_url,
+                                                   MaxNumberOfMessages=10,
+                                                   WaitTimeSeconds=self.wait_time,
+                                                   VisibilityTimeout=self.visibility_timeout,
+                                                   AttributeNames=['MessageGroupId'],
+                                                   MessageAttributeNames=['All']).get('Messages', [])
+            except (ClientError, BotoCoreError) as e:
+                print('Could not receive messages, retrying in {:.1f}s:'.format(backoff), e)
+                self._release(10)
+                self.stopped.wait(backoff * random.uniform(0.5, 1.5))
+                backoff = min(backoff * 2, 20)
+                continue
+            backoff = 0.1
+            # Give back the room which was not used
+            self._release(10 - len(messages))
+            for msg in messages:
+                group = msg.get('Attributes', {}).get('MessageGroupId')
+                with self.lock:
+                    self.in_progress[msg['ReceiptHandle']] = msg
+                    if group is not None:
+                        # Wait behind the message of the same group in progress
+                        if group in self.group_waiting:
+                            self.group_waiting[group].append(msg)
+                            continue
+                        self.group_waiting[group] = []
+                self._submit(msg)
+
+    # Hand a message to the pool of workers
+    # After a drain timeout the pool takes no more work and the message is left to become visible again
+    def _submit(self, msg):
+        try:
+            future = self.executor.submit(self.handler, msg)
+        except RuntimeError:
+            self._abandon([msg])
+            return
+        future.add_done_callback(lambda future: self._done(msg, future))
+
+    # Forget messages which are not going to be handled, they become visible again after the visibility timeout
+    def _abandon(self, messages):
+        with self.lock:
+            for msg in messages:
+                self.in_progress.pop(msg['ReceiptHandle'], None)
+        self._release(len(messages))
+
+    # Free room in the pool for more messages
+    def _release(self, count):
+        with self.room:
+            self.outstanding -= count
+            self.room.notify_all()
+
+    # Called once the handler finished a message, a message handled without an error is deleted
+    def _done(self, msg, future):
+        # A message cancelled by a shutdown after the drain timeout counts as failed
+        failed = future.cancelled() or future.exception() is not None
+        with self.lock:
+            self.in_progress.pop(msg['ReceiptHandle'], None)
+            if not failed:
+                self.handled_count += 1
+                self.to_delete.append(msg)
+                full = len(self.to_delete) >= 10
+            else:
+                self.failed_count += 1
+                full = False
+            # Take the next message of the group, or after a failure give up the rest of the group
+            group = msg.get('Attributes', {}).get('MessageGroupId')
+            next_msg = None
+            skipped = []
+            if group is not None:
+                waiting = self.group_waiting.pop(group, [])
+                if failed:
+                    skipped = waiting
+                elif waiting:
+                    next_msg = waiting.pop(0)
+                    self.group_waiting[group] = waiting
+            for skipped_msg in skipped:
+                self.in_progress.pop(skipped_msg['ReceiptHandle'], None)
+        if full:
+            self._delete()
+        if next_msg is not None:
+            self._submit(next_msg)
+        self._release(1 + len(skipped))
+
+    # Delete the handled messages in batches of 10
+    def _delete(self):
+        with self.lock:
+            messages = self.to_delete
+            self.to_delete = []
+        for i in range(0, len(messages), 10):
+            for msg in delete_msg_batch(self.queue_url, messages[i:i + 10]):
+                print('Could not delete message', msg['MessageId'])
+
+    # Extend the visibility of all the messages still being handled, 10 messages per call
+    def _extend_visibility(self):
+        with self.lock:
+            messages = list(self.in_progress.values())
+        for i in range(0, len(messages), 10):
+            entries = [{'Id': str(j),
+                        'ReceiptHandle': msg['ReceiptHandle'],
+                        'VisibilityTimeout': self.visibility_timeout} for j, msg in enumerate(messages[i:i + 10])]
+            response = sqs.change_message_visibility_batch(QueueUrl=self.queue_url, Entries=entries)
+            # Messages finished in the meantime can not be extended anymore and are left alone
+            self.extended_count += len(response.get('Successful', []))
+
+    # Delete the handled messages every second and extend the visibility at a third of the timeout
+    # A failed call is tried again on the next round, the heartbeat must not stop while messages are handled
+    def _housekeeping_loop(self):
+        last_extend = time.time()
+        while not self.housekeeping_stopped.wait(1):
+            try:
+                self._delete()
+                if time.time() - last_extend >= self.visibility_timeout / 3:
+                    self._extend_visibility()
+                    last_extend = time.time()
+            except (ClientError, BotoCoreError) as e:
+                print('Housekeeping of the pool failed:', e)
+
+    # Stop receiving, wait for the messages in progress and delete the handled ones
+    # The visibility heartbeat runs until the workers are shut down, so the messages finishing meanwhile are not redelivered
+    def stop(self):
+        self.stopped.set()
+        with self.room:
+            self.room.notify_all()
+        for thread in self.threads:
+            thread.join()
+        # Wait for the messages received, the messages waiting behind their group are handed to the workers meanwhile
+        deadline = time.time() + self.drain_timeout
+        with self.room:
+            while self.in_progress and time.time() < deadline:
+                self.room.wait(min(0.5, max(deadline - time.time(), 0)))
+        # After the timeout the messages not started yet are cancelled, the running ones are still waited for
+        self.executor.shutdown(wait=True, cancel_futures=bool(self.in_progress))
+        self.housekeeping_stopped.set()
+        self.housekeeper.join()
+        self._delete()
+
+    # Run the pool until it is interrupted or the timeout in seconds has passed
+    def run(self, timeout=None):
+        self.start()
+        try:
+            self.stopped.wait(timeout)
+        except KeyboardInterrupt:
+            pass
+        self.stop()
+
+
+# Handle the messages of the standard queue on 8 threads for a minute, only when run as a script
+# as the pool blocks until the timeout
+if __name__ == '__main__':
+    worker_pool = SQSWorkerPool(QUEUE_NAME, handler=lambda msg: print(Codec.decode_text(msg_body(msg))), workers=8)
+    worker_pool.run(timeout=60)
+    print(worker_pool.handled_count, 'messages handled')
+
+
+# Create a limiter allowing a number of units per second, shared by several threads
+class RateLimiter:
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    # Wait until the units can be taken, the units may be more than the rate allows in a second
+    def acquire(self, units=1):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Take the units at once and wait for the tokens which are missing
+            self.tokens -= units
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+# Create a redrive which moves the messages of a dead letter queue back to the source queue
+#
+# - Several receivers long poll the dead letter queue at the same time
+# - The received messages are sent to the source queue in batches with their body and message attributes,
+#   a fifo message keeps its message group and gets a new deduplication id
+# - Only the messages sent successfully are deleted from the dead letter queue, in batches, the others
+#   become visible again after the visibility timeout and are moved on a later receive
+# - A failed call does not stop a receiver, a failed receive counts as an empty poll and the messages
+#   sent but not deleted are counted as failed, they are moved again once they are visible again
+# - The payloads stored in S3 are kept, the moved messages still point to them
+# - 'rate' limits the messages moved per second and the progress is printed every 'report_interval' seconds
+class DeadLetterRedrive:
+
+    def __init__(self, dead_letter_name, source_name, receivers=4, rate=None, max_messages=None,
+                 max_empty_polls=2, wait_time=5, visibility_timeout=60, report_interval=5):
+        self.dead_letter_name = dead_letter_name
+        self.source_name = source_name
+        self.dead_letter_url = queue_name_to_url(dead_letter_name)
+        self.source_url = queue_name_to_url(source_name)
+        self.fifo = source_name.endswith('.fifo')
+        self.receivers = receivers
+        self.limiter = RateLimiter(rate) if rate else None
+        self.max_messages = max_messages
+        self.max_empty_polls = max_empty_polls
+        self.wait_time = wait_time
+        self.visibility_timeout = visibility_timeout
+        self.report_interval = report_interval
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        # Counters of the redrive
+        self.received_count = 0
+        self.moved_count = 0
+        self.failed_count = 0
+        self.started = None
+
+    # Build the entry sending a received message to the source queue
+    def _entry(self, i, msg):
+        entry = {'Id': str(i), 'MessageBody': msg['Body']}
+        attributes = {}
+        for name, attr in msg.get('MessageAttributes', {}).items():
+            # Only the single values can be sent back, the list values are not supported by sqs
+            attributes[name] = {key: value for key, value in attr.items()
+                                if key in ('DataType', 'StringValue', 'BinaryValue')}
+        if attributes:
+            entry['MessageAttributes'] = attributes
+        if self.fifo:
+            system = msg.get('Attributes', {})
+            entry['MessageGroupId'] = system.get('MessageGroupId', 'redrive')
+            # The original id may still be in the 5 minute deduplication window of the source queue, which would
+            # accept the message without delivering it while it is deleted from the dead letter queue
+            entry['MessageDeduplicationId'] = str(uuid4())
+        return entry
+
+    # Reserve up to 10 messages of the maximum, returns how many messages to receive
+    def _reserve(self):
+        with self.lock:
+            if self.max_messages is None:
+                return 10
+            count = max(0, min(10, self.max_messages - self.received_count))
+            self.received_count += count
+            return count
+
+    # Move the messages of one receive, returns the number of messages received
+    def _move(self, max_msg):
+        try:
+            with queue_errors(self.dead_letter_name):
+                messages = sqs.receive_message(QueueUrl=self.dead_letter_url,
+                                               MaxNumberOfMessages=max_msg,
+                                               WaitTimeSeconds=self.wait_time,
+                                               VisibilityTimeout=self.visibility_timeout,
+                                               AttributeNames=['All'],
+                                               MessageAttributeNames=['All']).get('Messages', [])
+        except (ClientError, BotoCoreError) as e:
+            print('Could not receive from {}: {}'.format(self.dead_letter_name, e))
+            # Wait as long as an empty long poll before the next receive
+            self.stopped.wait(self.wait_time)
+            return 0
+        if not messages:
+            return 0
+        if self.limiter:
+            self.limiter.acquire(len(messages))
+        entries = [self._entry(i, msg) for i, msg in enumerate(messages)]
+        results = {}
+        # The messages received together may be above the size of a single batch
+        with queue_errors(self.source_name):
+            for batch in pack_batches(entries, keep_order=self.fifo):
+                results.update(send_entries(self.source_url, [entries[i] for i in batch]))
+        sent = [msg for i, msg in enumerate(messages) if 'MessageId' in results.get(str(i), {})]
+        try:
+            failed = delete_msg_batch(self.dead_letter_url, sent, delete_payloads=False)
+        except (ClientError, BotoCoreError) as e:
+            print('Could not delete {} moved messages from {}: {}'.format(len(sent), self.dead_letter_name, e))
+            failed = sent
+        with self.lock:
+            self.moved_count += len(sent) - len(failed)
+            self.failed_count += len(messages) - len(sent) + len(failed)
+        return len(messages)
+
+    # Receive and move messages until the dead letter queue is empty or the maximum is reached
+    def _receive_loop(self):
+        empty_polls = 0
+        while not self.stopped.is_set():
+            max_msg = self._reserve()
+            if max_msg == 0:
+                return
+            received = self._move(max_msg)
+            if self.max_messages is not None and received < max_msg:
+                # Give back the reservation which was not received
+                with self.lock:
+                    self.received_count -= max_msg - received
+            if received == 0:
+                empty_polls += 1
+                if empty_polls >= self.max_empty_polls:
+                    return
+            else:
+                empty_polls = 0
+
+    # Print the progress and the throughput of the redrive
+    def report(self):
+        elapsed = time.time() - self.started
+        print('Moved {} messages in {:.1f}s, {:.0f} messages/s, {} failed'.format(
+            self.moved_count, elapsed, self.moved_count / max(elapsed, 1e-9), self.failed_count))
+
+    # Run the receivers until the dead letter queue is drained, returns the number of messages moved
+    def run(self):
+        self.started = time.time()
+        threads = [threading.Thread(target=self._receive_loop, daemon=True) for _ in range(self.receivers)]
+        for thread in threads:
+            thread.start()
+        next_report = self.started + self.report_interval
+        try:
+            while any(thread.is_alive() for thread in threads):
+                time.sleep(0.1)
+                if time.time() >= next_report:
+                    self.report()
+                    next_report += self.report_interval
+        except KeyboardInterrupt:
+            self.stopped.set()
+        for thread in threads:
+            thread.join()
+        self.report()
+        return self.moved_count
+
+    # Stop the receivers after their current receive
+    def stop(self):
+        self.stopped.set()
+
+
+# Move the messages which failed 5 times in 'Queue_and_dead' back from its dead letter queue, at most 500 messages a second,
+# only when run as a script
+if __name__ == '__main__':
+    redrive = DeadLetterRedrive(QUEUE_NAME, 'Queue_and_dead', receivers=8, rate=500)
+    moved_count = redrive.run()
+
+
 # Function to delete multiple queues
 def delete_queues(*args):
     q_list = []
@@ -277,10 +1163,12 @@ def delete_queues(*args):
     queue_url_list = []
     for q in q_list:
         # Get the urls of the queues to be deleted
-        queue_url_list.append(sqs.get_queue_url(QueueName=q)['QueueUrl'])
-    for queue in queue_url_list:
+        queue_url_list.append(queue_resolver.url(q))
+    for q, queue in zip(q_list, queue_url_list):
         # Delete the queues one by one
         sqs.delete_queue(QueueUrl=queue)
+        # Forget the cached url and attributes of the deleted queue
+        queue_resolver.invalidate(q)
         
 # Delete the two queues given as the arguments 
 delete_queues(QUEUE_NAME, FIFO_QUEUE)